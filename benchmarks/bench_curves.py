@@ -0,0 +1,45 @@
+"""Counting curves, and querying a loaded cube."""
+
+import pytest
+import cubealyzer
+import mtg
+
+
+@pytest.fixture(scope='module')
+def cube(cube_file, card_db):
+    return cubealyzer.Cube(cube_file, card_db)
+
+
+def test_counts(benchmark, cube):
+    """The one pass over a cube that counts every curve."""
+    benchmark(cubealyzer.Counts, cube)
+
+
+def test_update_curve(benchmark, cube):
+    """Curves of all five faction types."""
+
+    def update():
+        for faction_type in mtg.Faction.fsh:
+            cube.update_curve(faction_type)
+
+    benchmark(update)
+
+
+def test_query(benchmark, cube):
+    expression = 'type:creature cmc<=3 faction:golgari -sub:wizard'
+    benchmark(cube.query, expression)
+
+
+def test_reload(benchmark, cube):
+    """Applying a change of a few cards to a loaded cube."""
+    names = list(cube.contents)
+    before = cube.contents.copy()
+    after = before.copy()
+    for name in names[:5]:
+        del after[name]
+
+    def change():
+        cube.update(after)
+        cube.update(before)
+
+    benchmark(change)
@@ -0,0 +1,51 @@
+"""Cards with several faces: parsing them, and counting a cube in which most
+cards have two (see multiface_cards). Compare with the same benchmarks in
+bench_load.py and bench_curves.py, on cards with one face."""
+
+import importlib.util
+import pytest
+import cubealyzer
+import mtg
+
+
+@pytest.fixture(scope='module')
+def cube(cube_file, multiface_db):
+    return cubealyzer.Cube(cube_file, multiface_db)
+
+
+def test_parse_card(benchmark, multiface_cards):
+    """Reducing Scryfall data to card records, faces and all."""
+    data = list(multiface_cards.values())[:1000]
+    benchmark(lambda: [mtg.parse_card(card) for card in data])
+
+
+def test_cube_init(benchmark, cube_file, multiface_db):
+    store = mtg.CardStore(multiface_db)
+    benchmark(cubealyzer.Cube, cube_file, None, store=store)
+    store.close()
+
+
+def test_counts(benchmark, cube):
+    benchmark(cubealyzer.Counts, cube)
+
+
+def test_update_curve(benchmark, cube):
+
+    def update():
+        for faction_type in mtg.Faction.fsh:
+            cube.update_curve(faction_type)
+
+    benchmark(update)
+
+
+def test_query(benchmark, cube):
+    expression = 'type:creature cmc<=3 faction:golgari -sub:wizard'
+    benchmark(cube.query, expression)
+
+
+@pytest.mark.skipif(not importlib.util.find_spec('numpy'),
+                    reason="needs NumPy")
+def test_simulation(benchmark, cube):
+    """Simulating drafts, each card counting for all its faces."""
+    sim = cube.simulation('g', 'creature', packs=3)
+    benchmark(sim.simulate, 1000, 1)
@@ -0,0 +1,31 @@
+"""Which factions can play a mana cost, with cold and hot caches."""
+
+import itertools
+import mtg
+
+# Every cost of up to three symbols, plus some longer ones
+symbols = ['{W}', '{U}', '{B}', '{R}', '{G}', '{C}', '{1}', '{2}', '{X}',
+           '{W/U}', '{B/G}', '{2/R}', '{U/P}', '{G/W/P}']
+costs = sorted({''.join(c) for n in range(4) for c in
+                itertools.combinations_with_replacement(symbols, n)})
+
+
+def clear_caches():
+    mtg.ManaCost.parse.cache_clear()
+    mtg.Faction.playable_mask.cache_clear()
+
+
+def who_can_play_all():
+    for cost in costs:
+        mtg.Faction.who_can_play(cost)
+
+
+def test_who_can_play_cold(benchmark):
+    benchmark.extra_info['costs'] = len(costs)
+    benchmark.pedantic(who_can_play_all, setup=clear_caches, rounds=20)
+
+
+def test_who_can_play_hot(benchmark):
+    benchmark.extra_info['costs'] = len(costs)
+    who_can_play_all()
+    benchmark(who_can_play_all)
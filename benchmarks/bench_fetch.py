@@ -0,0 +1,17 @@
+"""Downloading the card data of a cube from a local stand-in for Scryfall,
+without rate limiting, to measure the throughput of the fetch path."""
+
+import cubealyzer
+import mtg
+
+
+def test_fetch(benchmark, cube_file, scryfall):
+    names = list(cubealyzer.read_cube(cube_file))
+    benchmark.extra_info['cards'] = len(names)
+
+    def fetch():
+        cards = mtg.Cards(api_url=scryfall)
+        cards.rate_limit = 0
+        assert cards.add_cards(names) == []
+
+    benchmark.pedantic(fetch, rounds=3)
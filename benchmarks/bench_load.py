@@ -0,0 +1,39 @@
+"""Reading cubes and card data."""
+
+import cubealyzer
+import mtg
+
+
+def test_read_cube(benchmark, cube_file):
+    benchmark(cubealyzer.read_cube, cube_file)
+
+
+def test_cube_init(benchmark, cube_file, card_db):
+    """Reading a cube whose card data is all in the database, and counting
+    its curves."""
+    store = mtg.CardStore(card_db)
+    benchmark(cubealyzer.Cube, cube_file, None, store=store)
+    store.close()
+
+
+def test_card_lookup(benchmark, cube_file, card_db):
+    """Looking up every card of a cube in the database."""
+    store = mtg.CardStore(card_db)
+    names = list(cubealyzer.read_cube(cube_file))
+    benchmark(lambda: mtg.Cards(store=store).add_cards(names))
+    store.close()
+
+
+def test_card_save(benchmark, cube_file, scryfall_cards, tmp_path):
+    """Saving the downloaded cards of a cube to a new database."""
+    names = list(cubealyzer.read_cube(cube_file))
+    cards = {name: mtg.parse_card(scryfall_cards[name]) for name in names}
+    paths = iter(str(tmp_path / "{}.db".format(i)) for i in range(10 ** 6))
+
+    def save():
+        store = mtg.CardStore(next(paths))
+        store.upsert(cards)
+        store.close()
+
+    benchmark(save)
+
@@ -0,0 +1,111 @@
+"""Fixtures for the benchmarks: synthetic cubes of several sizes, card
+databases built for them (one where most cards have several faces), and a
+local stand-in for Scryfall."""
+
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+import mtg  # noqa: E402
+from startup import synthetic_card  # noqa: E402
+
+sizes = (100, 1000, 10000)
+
+
+def card_names(size):
+    return ["Card {:05}".format(i) for i in range(size)]
+
+
+@pytest.fixture(scope='session')
+def scryfall_cards():
+    """Made-up Scryfall data for the cards of the largest cube, by name."""
+    return {name: synthetic_card(name, i) for i, name in
+            enumerate(card_names(max(sizes)))}
+
+
+@pytest.fixture(scope='session')
+def card_db(tmp_path_factory, scryfall_cards):
+    """A card database holding every card of every cube."""
+    path = str(tmp_path_factory.mktemp('db') / 'cards.db')
+    store = mtg.CardStore(path)
+    store.upsert({name: mtg.parse_card(card) for name, card in
+                  scryfall_cards.items()})
+    store.close()
+    return path
+
+
+@pytest.fixture(scope='session', params=sizes, ids=lambda n: "{}".format(n))
+def cube_file(request, tmp_path_factory):
+    """A cube CSV file of the parametrized size."""
+    path = tmp_path_factory.mktemp('cube') / 'cube.csv'
+    path.write_text(''.join('"{}"\n'.format(name) for name in
+                            card_names(request.param)))
+    return str(path)
+
+
+def multiface_card(name, i):
+    """Made-up Scryfall data for a card with two faces, of a layout and
+    faces varied by i."""
+    layouts = ['split', 'modal_dfc', 'adventure', 'transform']
+    front = synthetic_card("{} Front".format(name), i)
+    back = synthetic_card("{} Back".format(name), i + 3)
+    faces = [{k: face[k] for k in ('name', 'mana_cost', 'type_line')} for
+             face in (front, back)]
+    return dict(synthetic_card(name, i), layout=layouts[i % len(layouts)],
+                card_faces=faces, cmc=front['cmc'] + back['cmc'])
+
+
+@pytest.fixture(scope='session')
+def multiface_cards():
+    """Made-up Scryfall data for a cube of the largest size in which three
+    cards in four have two faces, by name."""
+    return {name: multiface_card(name, i) if i % 4 else
+            synthetic_card(name, i) for i, name in
+            enumerate(card_names(max(sizes)))}
+
+
+@pytest.fixture(scope='session')
+def multiface_db(tmp_path_factory, multiface_cards):
+    """A card database holding the cards of multiface_cards."""
+    path = str(tmp_path_factory.mktemp('db') / 'cards.db')
+    store = mtg.CardStore(path)
+    store.upsert({name: mtg.parse_card(card) for name, card in
+                  multiface_cards.items()})
+    store.close()
+    return path
+
+
+@pytest.fixture(scope='session')
+def scryfall(scryfall_cards):
+    """URL of a local server answering Scryfall's collection endpoint."""
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            length = int(self.headers['Content-Length'])
+            body = json.loads(self.rfile.read(length))
+            data = [scryfall_cards[identifier['name']] for identifier in
+                    body['identifiers']]
+            reply = json.dumps({'object': 'list', 'not_found': [],
+                                'data': data}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(reply)))
+            self.end_headers()
+            self.wfile.write(reply)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, args=(.05,),
+                     daemon=True).start()
+    yield 'http://127.0.0.1:{}'.format(server.server_port)
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""Startup time of a text report on a cube whose card data is all cached.
+
+Builds a card database for the cube (with made-up card data, so no network
+access is needed), then runs cubealyzer under python -X importtime several
+times. Reports the median wall time and import time, and fails if any module
+that should only be imported on demand (for plots, downloads or terminal
+colors) was imported, or if startup is slower than --max-ms."""
+
+import argparse
+import csv
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+import mtg  # noqa: E402
+
+cubealyzer = os.path.join(os.path.dirname(here), 'cubealyzer.py')
+
+# Not needed for a text report on a cached cube
+lazy_modules = ('matplotlib', 'requests', 'colorama', 'numpy')
+
+
+def synthetic_card(name, i):
+    """Made-up Scryfall data for a card, varied by i."""
+    costs = ['{W}', '{1}{U}', '{B}{B}', '{2}{R}', '{1}{G}{G}', '{W/U}',
+             '{1}{B}{G}', '{3}', '{X}{R}', '{U/P}', '']
+    type_lines = ['Creature — Human Wizard', 'Instant', 'Sorcery', 'Artifact',
+                  'Enchantment', 'Land', 'Creature — Elf Druid',
+                  'Legendary Planeswalker — Jace']
+    cost = costs[i % len(costs)]
+    mana = mtg.ManaCost.parse(cost)
+    cmc = mana.generic + len(mana.colored + mana.hybrid + mana.phyrexian)
+    return {'object': 'card', 'name': name, 'mana_cost': cost,
+            'type_line': type_lines[i % len(type_lines)], 'cmc': float(cmc)}
+
+
+def cube_names(csv_file):
+    with open(csv_file, newline='') as cube_file:
+        return [row[0] for row in csv.reader(cube_file, escapechar='\\') if
+                len(row) > 0]
+
+
+def run(cube, db):
+    """Run one report. Returns wall time (s), import time of modules imported
+    at top level (s), and the set of top-level modules imported. Counts are
+    cached next to the database, so runs after the first read them back."""
+
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', cubealyzer,
+                             '--db', db, '--cache-dir', os.path.join(
+                                 os.path.dirname(db), 'results'), '-c', '-g',
+                             cube],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            text=True, check=True)
+    wall = time.perf_counter() - start
+
+    imported = set()
+    total = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        if not name.startswith('  '):
+            # Interpreter startup is not ours to speed up
+            if name.strip() not in ('site', 'encodings'):
+                total += int(cumulative)
+        imported.add(name.strip().split('.')[0])
+
+    return wall, total / 1e6, imported
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('cubefile', nargs='?', default=os.path.join(
+        os.path.dirname(here), 'my_modern_cube.csv'), help='The cube file \
+        (default: my_modern_cube.csv)')
+    parser.add_argument('-r', '--runs', type=int, default=10,
+                        help='Number of runs (default: 10)')
+    parser.add_argument('--max-ms', type=float, default=None,
+                        help='Fail if the median run takes longer')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = os.path.join(tmp, 'cards.db')
+        cards = mtg.Cards(db)
+        for i, name in enumerate(dict.fromkeys(cube_names(args.cubefile))):
+            cards.db[name] = mtg.parse_card(synthetic_card(name, i))
+            cards.new.add(name)
+        cards.save()
+
+        # Warm up the file system cache and bytecode
+        run(args.cubefile, db)
+        runs = [run(args.cubefile, db) for _ in range(args.runs)]
+
+    wall = statistics.median(r[0] for r in runs) * 1000
+    imports = statistics.median(r[1] for r in runs) * 1000
+    print("median wall time   {:8.1f} ms".format(wall))
+    print("median import time {:8.1f} ms".format(imports))
+
+    failed = False
+    unwanted = set.union(*(r[2] for r in runs)).intersection(lazy_modules)
+    if unwanted:
+        print("imported needlessly: {}".format(", ".join(sorted(unwanted))))
+        failed = True
+    if args.max_ms is not None and wall > args.max_ms:
+        print("slower than {} ms".format(args.max_ms))
+        failed = True
+
+    exit(1 if failed else 0)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""On-disk cache of results derived from cubes (see cubealyzer.Cube), so
+that analyzing an unchanged cube again, with the same card data, takes one
+small file read instead of looking up and counting every card."""
+
+import contextlib
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+
+# Changed whenever the results cached change form, so that older entries
+# are no longer found
+format_version = 4
+
+
+class ResultCache():
+    """Results pickled in a directory, one file per key. Reading an entry
+    marks it as recently used, and once the entries take up more than
+    max_bytes the least recently used are evicted. Entries are written to a
+    temporary file and renamed into place, so that any number of processes
+    can share a cache without reading half-written entries."""
+
+    max_bytes = 64 * 2 ** 20
+
+    suffix = '.pickle'
+
+    def __init__(self, directory, max_bytes=None):
+        self.directory = directory
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+
+    def key(self, data, version):
+        """Returns the key of results derived from cube data (the bytes of
+        a cube file) with the given version of card data (see
+        mtg.CardStore.version)."""
+        digest = hashlib.sha256(data)
+        digest.update("\0{}\0{}".format(format_version, version).encode())
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def get(self, key, default=None):
+        """Returns the results cached under a key, or default if there are
+        none."""
+
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as entry:
+                value = pickle.load(entry)
+        except FileNotFoundError:
+            return default
+        except Exception as e:
+            # Unreadable, e.g. written by a version whose classes differ
+            logging.warning("Dropping unreadable cache entry %s: %s", path, e)
+            self.invalidate(key)
+            return default
+
+        # Evicted since, perhaps, by another process
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(path)
+
+        return value
+
+    def put(self, key, value):
+        """Caches results under a key, then evicts the least recently used
+        entries beyond max_bytes."""
+
+        os.makedirs(self.directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as entry:
+                pickle.dump(value, entry, pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, self.path(key))
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(temp_path)
+            raise
+
+        self.evict()
+
+    def entries(self):
+        """Returns (last used, size, path) of every entry, least recently
+        used first."""
+
+        entries = list()
+        with contextlib.suppress(FileNotFoundError), \
+                os.scandir(self.directory) as files:
+            for f in files:
+                if not f.name.endswith(self.suffix):
+                    continue
+                with contextlib.suppress(FileNotFoundError):
+                    stat = f.stat()
+                    entries.append((stat.st_mtime, stat.st_size, f.path))
+
+        return sorted(entries)
+
+    def evict(self):
+        """Removes the least recently used entries until the rest take up
+        no more than max_bytes."""
+
+        entries = self.entries()
+        size = sum(entry[1] for entry in entries)
+        for last_used, entry_size, path in entries:
+            if size <= self.max_bytes:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            size -= entry_size
+
+    def invalidate(self, key=None):
+        """Removes the entry for a key, or every entry if no key is
+        given."""
+
+        paths = [self.path(key)] if key is not None else \
+            [entry[2] for entry in self.entries()]
+        for path in paths:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+
+    def __len__(self):
+        return len(self.entries())
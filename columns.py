@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""Columnar view of a cube for vectorized analysis. Requires NumPy."""
+
+from collections import Counter
+import numpy as np
+import mtg
+
+
+class Columns():
+    """The contents of a cube as arrays with one entry per distinct card, or
+    per face of cards with several faces that can be cast (see
+    mtg.card_faces): names (as in cubealyzer.Index), copies, cmc, castable
+    (a faction mask, see mtg.Faction), card (which of card_names the entry
+    is of), and boolean matrices of type and subtype membership whose
+    columns are named by types and subtypes. Curves and counts are computed
+    with masked sums rather than per-card conditions. Type None stands for
+    any nonland permanent and mtg.any_type for any card, as in
+    cubealyzer.Counts."""
+
+    def __init__(self, cube):
+
+        # The cards of the cube, and their copies
+        self.card_names = list(cube.contents)
+        self.card_copies = np.array([cube.contents[name] for name in
+                                     self.card_names], dtype=np.int64)
+
+        self.names = list()
+        card = list()
+        cards = list()
+        for i, name in enumerate(self.card_names):
+            faces = mtg.card_faces(cube.cards.get(name))
+            for face in faces:
+                self.names.append(face['name'] if len(faces) > 1 else name)
+                card.append(i)
+                cards.append(face)
+
+        self.card = np.array(card, dtype=np.int64)
+        self.copies = self.card_copies[self.card]
+        self.cmc = np.array([card.get('cmc', 0) for card in cards],
+                            dtype=float)
+        self.castable = np.array([mtg.Faction.playable_mask(
+            mtg.card_mana(card)) for card in cards], dtype=np.int64)
+
+        # Curves are indexed by position in cmcs, since cmc may be fractional
+        self.cmcs, self.cmc_index = np.unique(self.cmc, return_inverse=True)
+
+        self.types, self.type_matrix = self.membership(cards, 'types')
+        self.subtypes, self.subtype_matrix = self.membership(cards,
+                                                             'subtypes')
+
+    def membership(self, cards, key):
+        """Returns the sorted list of values of a list field of the cards,
+        and a boolean matrix of which card has which value."""
+
+        values = sorted({v for card in cards for v in card.get(key)})
+        column = {v: i for i, v in enumerate(values)}
+
+        matrix = np.zeros((len(cards), len(values)), dtype=bool)
+        for row, card in enumerate(cards):
+            matrix[row, [column[v] for v in card.get(key)]] = True
+
+        return values, matrix
+
+    def has(self, values, matrix, value):
+        """Boolean column for one value of a membership matrix."""
+        if value in values:
+            return matrix[:, values.index(value)]
+        return np.zeros(len(self.names), dtype=bool)
+
+    def select(self, faction=None, card_type=mtg.any_type, sub_type=None):
+        """Returns a boolean array selecting the cards playable by the faction
+        (any faction if None) of the given type and subtype (any subtype if
+        None)."""
+
+        selected = np.ones(len(self.names), dtype=bool)
+
+        if faction is not None:
+            selected &= (self.castable & mtg.Faction.bit[faction]) != 0
+
+        if card_type is None:
+            selected &= self.type_matrix[:, [i for i, t in
+                                             enumerate(self.types) if t in
+                                             mtg.permanent_types]].any(axis=1)
+        elif card_type != mtg.any_type:
+            selected &= self.has(self.types, self.type_matrix, card_type)
+
+        if sub_type is not None:
+            selected &= self.has(self.subtypes, self.subtype_matrix, sub_type)
+
+        return selected
+
+    def curve(self, faction, card_type='creature', sub_type=None,
+              where=None):
+        """Returns the mana curve, a collections.Counter of the form
+        {cmc: num}, of the given faction, type and subtype, optionally
+        restricted further by a boolean array (e.g. cols.cmc <= 3)."""
+
+        selected = self.select(faction, card_type, sub_type)
+        if where is not None:
+            selected &= where
+
+        counts = np.bincount(self.cmc_index[selected],
+                             weights=self.copies[selected],
+                             minlength=len(self.cmcs))
+
+        return Counter({cmc: int(n) for cmc, n in zip(self.cmcs.tolist(),
+                                                      counts) if n})
+
+    def curves(self, faction_type, card_type='creature', sub_type=None,
+               where=None):
+        """Returns { faction : curve } for every faction of a type, computed
+        for all of them at once."""
+
+        factions = mtg.Faction.get_factions(faction_type)
+
+        selected = self.select(None, card_type, sub_type)
+        if where is not None:
+            selected &= where
+        weights = np.where(selected, self.copies, 0)
+
+        # factions x cards, times cards x cmcs
+        playable = np.array([(self.castable & mtg.Faction.bit[f]) != 0 for f
+                             in factions], dtype=np.int64)
+        by_cmc = np.zeros((len(self.names), len(self.cmcs)), dtype=np.int64)
+        by_cmc[np.arange(len(self.names)), self.cmc_index] = weights
+        counts = playable @ by_cmc
+
+        cmcs = self.cmcs.tolist()
+        return {f: Counter({cmc: int(n) for cmc, n in zip(cmcs, row) if n})
+                for f, row in zip(factions, counts)}
+
+    def total(self, faction, card_type=mtg.any_type, sub_type=None,
+              where=None):
+        """Returns the number of cards of the given faction, type and
+        subtype. Duplicates count, but each face of a card does not."""
+
+        selected = self.select(faction, card_type, sub_type)
+        if where is not None:
+            selected &= where
+
+        cards = np.zeros(len(self.card_names), dtype=bool)
+        cards[self.card[selected]] = True
+        return int(self.card_copies[cards].sum())
+
+    def matching(self, where):
+        """Returns a collections.Counter of the names (and copies) of the
+        cards selected by a boolean array."""
+        return Counter({self.names[i]: int(self.copies[i]) for i in
+                        np.flatnonzero(where)})
@@ -3,27 +3,370 @@
 import argparse
 import atexit
 import os.path
+import sys
+import io
 import csv
 import logging
-from collections import Counter
-from colorama import init, Style
-import matplotlib.pyplot as plt
+import signal
+import contextlib
+import queue
+import threading
+import time
+from collections import Counter, defaultdict
 import mtg
+import pips
 # import mtgtests
 
 # TODO
 # Account for changelings in subtypes (or not)
 
-# Delete unused card info from JSON caches
+# matplotlib and colorama are imported only when needed, since importing
+# them takes much longer than analyzing a cube with cached card data.
 
-# colorama init() (only called in __main__)
+
+class Style():
+    """Stands in for colorama.Style when output is not to a terminal (see
+    __main__)."""
+    BRIGHT = ''
+    RESET_ALL = ''
+
+
+# Card data downloaded for any cube is kept here
+default_db = os.path.join(os.path.expanduser('~'), '.cache', 'cubealyzer',
+                          'cards.db')
+
+# Results derived from cubes are cached here (see cache.py)
+default_cache = os.path.join(os.path.dirname(default_db), 'results')
+
+
+# Card types in the names of plot files
+plot_names = {None: 'permanent', mtg.any_type: 'any'}
+
+# The figure rendered to by this process (see figure)
+_figure = None
+
+
+def figure():
+    """Returns a matplotlib Figure for rendering plots to files, which is
+    created the first time and reused after. It is not managed by pyplot, so
+    needs no display and is never shown."""
+
+    global _figure
+    if _figure is None:
+        from matplotlib.figure import Figure
+        _figure = Figure(figsize=(8, 6))
+
+    return _figure
+
+
+class Timings():
+    """Wall time spent in each phase of a run (see phase), for --timings."""
+
+    def __init__(self):
+        # phase : seconds, in the order first entered
+        self.phases = Counter()
+
+        # The mtg.Cards whose statistics to report, if any
+        self.cards = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Context manager adding the time spent in it to a phase."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.perf_counter() - start
+
+    def report(self, file=None):
+        """Display the time of each phase, the statistics of the card data
+        (see mtg.Cards.tally), and those of the mana cost caches."""
+
+        file = file or sys.stderr
+
+        print("{}Time in:{}".format(Style.BRIGHT, Style.RESET_ALL), file=file)
+        for name, seconds in self.phases.items():
+            print("{:16}{:.1f} ms".format(name, seconds * 1000), file=file)
+
+        if self.cards is not None:
+            stats = self.cards.stats
+            print("{}Card data:{}".format(Style.BRIGHT, Style.RESET_ALL),
+                  file=file)
+            print("{:16}{}".format('in memory', stats['memory']), file=file)
+            print("{:16}{}".format('from database', stats['store']),
+                  file=file)
+            print("{:16}{}".format('downloaded', stats['downloaded']),
+                  file=file)
+            print("{:16}{}".format('not found', stats['not_found']),
+                  file=file)
+            print("{:16}{} ({} retries)".format('API requests',
+                                                stats['requests'],
+                                                stats['retries']), file=file)
+            print("{:16}{:.1f} ms".format('rate limited',
+                                            stats['rate_limited'] * 1000),
+                  file=file)
+            print("{:16}{:.1f} ms".format('backing off',
+                                            stats['backoff'] * 1000),
+                  file=file)
+
+        print("{}Caches:{}".format(Style.BRIGHT, Style.RESET_ALL), file=file)
+        for name, cached in (('mana costs', mtg.ManaCost.parse),
+                             ('playable masks', mtg.Faction.playable_mask)):
+            info = cached.cache_info()
+            print("{:16}{} hits, {} misses".format(name, info.hits,
+                                                   info.misses), file=file)
+
+
+# Phases of this run
+timings = Timings()
+
+
+def read_cube(csv_file):
+    """Returns the contents of a cube CSV file by { name : count }."""
+
+    with open(csv_file, newline='') as cube_file:
+        return parse_cube(cube_file)
+
+
+def parse_cube(lines):
+    """Returns the contents of a cube by { name : count }, from the lines of
+    a CSV export."""
+
+    contents = Counter()
+
+    # Card names in cubes, with repeats
+    for name in [row[0] for row in csv.reader(lines, escapechar='\\') if
+                 len(row) > 0]:
+        logging.info("Adding %s", name)
+        contents[name] += 1
+
+    return contents
+
+
+def stream_cube(lines, cards, queue_size=1024):
+    """Returns the contents of a cube by { name : count } from the lines of
+    a CSV export (an open file, standard input or any iterable of lines),
+    and the list of names whose card data could not be found. Card data is
+    looked up and downloaded (see mtg.Cards.add_batches) by a background
+    thread as names are read, taking them from a queue of at most
+    queue_size names, so the first request is made at once, up to
+    cards.workers are in flight, and memory use does not grow with the
+    input."""
+
+    names = queue.Queue(queue_size)
+    missing = list()
+    errors = list()
+
+    def batches():
+        done = False
+        while not done:
+            # Wait for one name, then take as many as arrive promptly
+            batch = [names.get()]
+            while len(batch) < cards.batch_size and batch[-1] is not None:
+                try:
+                    batch.append(names.get(timeout=.05))
+                except queue.Empty:
+                    break
+            done = batch[-1] is None
+            batch = [name for name in batch if name is not None]
+            if batch:
+                yield batch
+
+    def resolve():
+        arriving = batches()
+        try:
+            with timings.phase('card data'):
+                missing.extend(cards.add_batches(arriving))
+        except BaseException as e:
+            errors.append(e)
+            # Keep draining the queue so reading can finish
+            for batch in arriving:
+                pass
+
+    resolver = threading.Thread(target=resolve, daemon=True)
+    resolver.start()
+
+    contents = Counter()
+    try:
+        for row in csv.reader(lines, escapechar='\\'):
+            if len(row) > 0:
+                logging.info("Adding %s", row[0])
+                if row[0] not in contents:
+                    names.put(row[0])
+                contents[row[0]] += 1
+    finally:
+        names.put(None)
+        resolver.join()
+
+    if errors:
+        raise errors[0]
+
+    return contents, missing
+
+
+class Counts():
+    """Mana curves of every faction, card type and subtype at once: card
+    counts keyed by (faction, type, subtype) and then cmc, collected in one
+    pass over a cube, along with their colored pips (see pips.Pips). Type
+    None stands for any nonland permanent and any_type for any card at all;
+    subtype None for any subtype; faction None for any faction."""
+
+    any_type = mtg.any_type
+    permanent_types = mtg.permanent_types
+
+    def __init__(self, cube=None):
+
+        # (faction, type, subtype) : Counter({ cmc : num })
+        self.table = defaultdict(Counter)
+
+        # (faction, type, subtype) : num, counting each card once however
+        # many of its faces match
+        self.totals = Counter()
+
+        # Colored pips by (faction, type) and cmc
+        self.pips = pips.Pips()
+
+        if cube is not None:
+            for name, num in cube.contents.items():
+                self.add(cube.cards.get(name), num)
+
+    def add(self, card, num=1):
+        """Count num copies of a card, or remove them if num is negative.
+        Each face of the card that can be cast counts in the curves (see
+        mtg.card_faces), but the card only once in the totals."""
+
+        keys = set()
+        for face in mtg.card_faces(card):
+            cmc = face.get('cmc', 0)
+
+            types = [self.any_type] + list(dict.fromkeys(face.get('types')))
+            if self.permanent_types.intersection(face.get('types')):
+                types.append(None)
+
+            subtypes = [None] + list(dict.fromkeys(face.get('subtypes')))
+
+            factions = list(mtg.Faction.names(
+                mtg.Faction.playable_mask(mtg.card_mana(face)))) + [None]
+
+            for faction in factions:
+                for card_type in types:
+                    for sub_type in subtypes:
+                        key = (faction, card_type, sub_type)
+                        self.table[key][cmc] += num
+                        keys.add(key)
+
+            self.pips.add(face, num)
+
+        for key in keys:
+            self.totals[key] += num
+
+    def curve(self, faction, card_type='creature', sub_type=None):
+        """Returns the mana curve, a collections.Counter of the form
+        {cmc: num}, of the given faction, type and subtype."""
+        # Unary + drops cmcs whose cards have all been removed
+        return +self.table.get((faction, card_type, sub_type), Counter())
+
+    def total(self, faction, card_type=any_type, sub_type=None):
+        """Returns the number of cards of the given faction, type and
+        subtype. Duplicates count, but each face of a card does not."""
+        return max(0, self.totals.get((faction, card_type, sub_type), 0))
+
+
+class Index():
+    """Names of the cards of a cube, and their copies, by type, subtype, cmc
+    and faction (see mtg.Faction) that can play them, so that cards can be
+    found without checking every one (see find and query.py). Kept up to date
+    as cards are added and removed. Cards with several faces that can be cast
+    (see mtg.card_faces) are indexed by the name of each face instead."""
+
+    def __init__(self, cube=None):
+
+        # { name : copies }
+        self.names = Counter()
+
+        # type, subtype, cmc or faction : { name : copies }
+        self.types = defaultdict(Counter)
+        self.subtypes = defaultdict(Counter)
+        self.cmcs = defaultdict(Counter)
+        self.factions = defaultdict(Counter)
+
+        if cube is not None:
+            for name, num in cube.contents.items():
+                self.add(name, cube.cards.get(name), num)
+
+    def add(self, name, card, num=1):
+        """Index num copies of a card, or remove them if num is negative."""
+
+        faces = mtg.card_faces(card)
+        for face in faces:
+            if len(faces) > 1:
+                name = face['name']
+
+            keys = [(self.types, t) for t in dict.fromkeys(face.get('types'))]
+            keys += [(self.subtypes, s) for s in
+                     dict.fromkeys(face.get('subtypes'))]
+            keys.append((self.cmcs, face.get('cmc', 0)))
+            keys += [(self.factions, f) for f in mtg.Faction.names(
+                mtg.Faction.playable_mask(mtg.card_mana(face)))]
+
+            for index, key in [(None, None)] + keys:
+                names = self.names if index is None else index[key]
+                names[name] += num
+                if names[name] <= 0:
+                    del names[name]
+                    if index is not None and not names:
+                        del index[key]
+
+    def playable(self, faction):
+        """Returns { name : copies } of the cards playable by a faction."""
+        return self.factions.get(faction, Counter())
+
+    def find(self, faction=None, card_type=mtg.any_type, sub_type=None,
+             cmc=None):
+        """Returns a collections.Counter of the names (and copies) of the
+        cards playable by the faction of the given type, subtype and cmc. As
+        in Counts, type None stands for any nonland permanent and any_type
+        for any card; faction, subtype or cmc None for any."""
+
+        selected = list()
+        if faction is not None:
+            selected.append(self.playable(faction))
+        if card_type is None:
+            permanents = Counter()
+            for t in mtg.permanent_types:
+                permanents |= self.types.get(t, Counter())
+            selected.append(permanents)
+        elif card_type != mtg.any_type:
+            selected.append(self.types.get(card_type, Counter()))
+        if sub_type is not None:
+            selected.append(self.subtypes.get(sub_type, Counter()))
+        if cmc is not None:
+            selected.append(self.cmcs.get(cmc, Counter()))
+
+        if not selected:
+            return Counter(self.names)
+
+        selected.sort(key=len)
+        return Counter({name: self.names[name] for name in
+                        set(selected[0]).intersection(*selected[1:])})
 
 
 class Cube():
     """Calculate statistics and mana curves for a cube file."""
 
-    def __init__(self, csv_file, json_file):
-        """Loads cube data from CSV file. Saves card data to JSON file."""
+    def __init__(self, csv_file, db_file, api_url='https://api.scryfall.com',
+                 store=None, contents=None, cards=None, cache=None):
+        """Loads cube data from CSV file (a path, '-' for standard input, or
+        an open file or other iterable of lines; see stream_cube), or takes
+        it from contents ({ name : count }) if given, in which case csv_file
+        only names the cube. Card data is looked up in, and downloaded data
+        saved to, the card store (an mtg.CardStore) given or opened at
+        db_file, unless an mtg.Cards is given to share; mtg.CardAPIError is
+        raised if the API fails, and mtg.CardsNotFoundError if it does not
+        know some of the cards. Given a cache.ResultCache, the contents,
+        counts and index of a cube file are read from it instead, if neither
+        the file nor the card data in the store has changed since they were
+        cached."""
 
         # factiontype[faction][type][subtype]
         self.curve = dict()
@@ -32,28 +375,108 @@ class Cube():
         self.contents = Counter()
 
         # Load card info
-        self.cards = mtg.Cards(json_file)
-
-        # Save downloaded card data as a JSON file on exit
-        atexit.register(self.cards.save)
-
-        # Read cube CSV file into self.contents
-        with open(csv_file, newline='') as cube_file:
-
-            # Card names in cubes, with repeats
-            for name in [row[0] for row in csv.reader(cube_file,
-                                                      escapechar='\\') if
-                         len(row) > 0]:
-
-                # Download any uncached card data from public API
-                logging.info("Adding %s", name)
-                self.cards.add_card(name)
+        if cards is None:
+            cards = mtg.Cards(db_file, api_url=api_url, store=store)
+
+            # Save downloaded card data to the card store on exit
+            atexit.register(cards.save)
+        self.cards = cards
+
+        # The cube file, read once for both the cache key and its contents
+        data = None
+        if (cache is not None and contents is None and
+                isinstance(csv_file, str) and csv_file != '-' and
+                self.cards.version() is not None):
+            with timings.phase('cache'):
+                with open(csv_file, 'rb') as cube_file:
+                    data = cube_file.read()
+                cached = cache.get(cache.key(data, self.cards.version()))
+            if cached is not None:
+                self.csv_file = csv_file
+                self.contents, self.counts, self.index = cached
+                return
+
+        # Read cube CSV file into self.contents, downloading any uncached
+        # card data from public API in bulk meanwhile
+        if contents is not None:
+            with timings.phase('card data'):
+                missing = self.cards.add_cards(contents)
+        elif csv_file == '-':
+            with timings.phase('read cube'):
+                contents, missing = stream_cube(sys.stdin, self.cards)
+            csv_file = 'stdin'
+        elif data is not None:
+            with timings.phase('read cube'):
+                contents, missing = stream_cube(io.TextIOWrapper(
+                    io.BytesIO(data), newline=''), self.cards)
+        elif isinstance(csv_file, str):
+            with timings.phase('read cube'), open(csv_file,
+                                                  newline='') as cube_file:
+                contents, missing = stream_cube(cube_file, self.cards)
+        else:
+            with timings.phase('read cube'):
+                contents, missing = stream_cube(csv_file, self.cards)
+            csv_file = getattr(csv_file, 'name', 'stream')
+        self.contents = Counter(contents)
 
-                self.contents[name] += 1
+        if missing:
+            raise mtg.CardsNotFoundError(missing)
 
         # Remember the cube identity
         self.csv_file = csv_file
 
+        # Every curve, from one pass over the cube
+        with timings.phase('count'):
+            self.counts = Counts(self)
+
+        # For finding cards (see find and query)
+        with timings.phase('index'):
+            self.index = Index(self)
+
+        if data is not None:
+            with timings.phase('cache'):
+                cache.put(cache.key(data, self.cards.version()),
+                          (self.contents, self.counts, self.index))
+
+    def update(self, contents):
+        """Changes the contents of the cube to contents ({ name : count }).
+        Only the cards added and removed are counted and indexed, and curves
+        already calculated are updated from the counts. Cards not found in
+        the API are left out, with a warning. Returns the changes as a
+        collections.Counter, negative for cards removed."""
+
+        delta = Counter(contents)
+        delta.subtract(self.contents)
+
+        missing = self.cards.add_cards([name for name, num in delta.items()
+                                        if num > 0 and
+                                        name not in self.contents])
+        if missing:
+            logging.warning("Cards not found in API: %s", ", ".join(missing))
+            for name in missing:
+                del delta[name]
+
+        for name, num in list(delta.items()):
+            if num:
+                self.counts.add(self.cards.get(name), num)
+                self.index.add(name, self.cards.get(name), num)
+                self.contents[name] += num
+            else:
+                del delta[name]
+        self.contents = +self.contents
+
+        for card_type, subtypes in self.curve.items():
+            for sub_type, faction_types in subtypes.items():
+                for faction_type in faction_types:
+                    self.update_curve(faction_type, card_type, sub_type)
+
+        return delta
+
+    def reload(self):
+        """Re-reads the cube CSV file and updates the cube to match it (see
+        update). Returns the changes."""
+        return self.update(read_cube(self.csv_file))
+
     def conditional_curve(self, *conditions):
         """Returns a collections.Counter of the form {cmc: num} for the given
         condition functions. This represents a mana curve."""
@@ -61,61 +484,113 @@ class Cube():
         curve = Counter()
 
         for name in self.contents:
-            card = self.cards.get(name)
-            if all(condition(card) for condition in conditions):
-                curve[card.get('cmc', 0)] += self.contents[name]
+            for face in mtg.card_faces(self.cards.get(name)):
+                if all(condition(face) for condition in conditions):
+                    curve[face.get('cmc', 0)] += self.contents[name]
 
         return curve
 
     def faction_curve(self, faction, card_type='creature', sub_type=None):
-        """Constructs and executes the required conditions as described by
-        types. If card_type is none it is assumed to mean "any nonland
-        permanent; if sub_type is None, it is ignored."""
+        """Returns the mana curve of cards playable by the faction (any
+        faction if it is None) of the given type and subtype. If card_type is
+        none it is assumed to mean "any nonland permanent; if sub_type is
+        None, it is ignored."""
 
-        if faction is not None:
-            condition_list = [lambda card: faction in mtg.Faction.who_can_play(card.get('cost'))]
-        else:
-            condition_list = []
-
-        if card_type is None:
-            def is_permanent(card):
-                return any(t in {'creature', 'enchantment', 'artifact',
-                                 'planeswalker'} for t in card.get('types'))
-            condition_list.append(is_permanent)
-
-        else:
-            condition_list.append(lambda card: card_type in card.get('types'))
-
-        if sub_type is not None:
-            condition_list.append(lambda card: sub_type in card.get('subtypes'))
-
-        return self.conditional_curve(*condition_list)
+        return self.counts.curve(faction, card_type, sub_type)
 
     def cards_matching_conditions(self, *conditions):
         """Returns a collections.Counter of card names in the cube object that
-        meet the specified condition functions. Example:
+        meet the specified condition functions, with any one of their faces
+        (see mtg.card_faces). Example:
         cube.cards_matching_conditions(lambda c: c.get('cmc') == 1"""
 
         results = Counter()
         for name, num in self.contents.items():
-            if all(condition(self.cards.get(name)) for condition in
-                   conditions):
+            if any(all(condition(face) for condition in conditions) for face
+                   in mtg.card_faces(self.cards.get(name))):
                 results[name] = num
 
         return results
 
+    def find(self, faction=None, card_type=mtg.any_type, sub_type=None,
+             cmc=None):
+        """Returns a collections.Counter of the names (and copies) of the
+        cards playable by the faction of the given type, subtype and cmc (see
+        Index.find). Example: cube.find('simic', 'creature', 'merfolk')"""
+        return self.index.find(faction, card_type, sub_type, cmc)
+
+    def query(self, expression):
+        """Returns a collections.Counter of the names (and copies) of the
+        cards matching a filter expression (see query.py), or of their faces
+        that do (see Index). Example:
+        cube.query('type:creature cmc<=2 faction:boros')"""
+        import query
+        return Counter({name: self.index.names[name] for name in
+                        query.compile(expression).match(self.index)})
+
+    def query_curve(self, expression):
+        """Returns the mana curve, a collections.Counter of the form
+        {cmc: num}, of the cards matching a filter expression."""
+
+        matches = self.query(expression)
+        curve = Counter()
+        for cmc, names in self.index.cmcs.items():
+            for name in matches.keys() & names.keys():
+                curve[cmc] += matches[name]
+
+        return curve
+
+    def print_query(self, expression):
+        """Displays the cards matching a filter expression and their curve."""
+
+        matches = self.query(expression)
+        print("{}Cards matching {}:{}".format(Style.BRIGHT, expression,
+                                              Style.RESET_ALL))
+        for name in sorted(matches):
+            print("{:3} {}".format(matches[name], name))
+        print("{:12}".format('curve'), end='')
+        for mana, num in sorted(self.query_curve(expression).items()):
+            print("{}{:.0f}{}:{:2} ".format(Style.BRIGHT, mana,
+                                            Style.RESET_ALL, num), end='')
+        print()
+
+    def columns(self):
+        """Returns a columnar view of the cube (a columns.Columns) for
+        vectorized queries. Requires NumPy."""
+        import columns
+        return columns.Columns(self)
+
+    def simulation(self, faction_type, card_type='creature', sub_type=None,
+                   packs=3, pack_size=15):
+        """Returns a simulation of the packs opened from the cube (a
+        simulate.Simulation). Requires NumPy."""
+        import simulate
+        return simulate.Simulation(self, faction_type, card_type, sub_type,
+                                   packs, pack_size)
+
     def update_curve(self, faction_type, card_type='creature', sub_type=None):
         """Updates the curve dictionary of cards with a particular type and
         optional subtype, broken down by the faction type given - 'c' colors,
         's' shards, 'w' wedges, and 'n' nephilim (four color combinations.)"""
 
-        self.curve.update({card_type: {sub_type: {faction_type: {}}}})
+        curves = self.curve.setdefault(card_type, {}).setdefault(sub_type, {})
+        curves[faction_type] = {}
 
         for faction in mtg.Faction.get_factions(faction_type):
-            self.curve[card_type][sub_type][faction_type][faction] =\
-                self.faction_curve(faction,
-                                   card_type=card_type,
-                                   sub_type=sub_type)
+            curves[faction_type][faction] = self.faction_curve(
+                faction, card_type=card_type, sub_type=sub_type)
+
+    def curve_totals(self):
+        """Returns the number of cards in each curve calculated so far, in
+        the form of the curve dictionary with a number in place of each
+        curve. Each card counts once, however many of its faces do in the
+        curve (see Counts)."""
+
+        return {card_type: {sub_type: {faction_type: {
+            faction: self.counts.total(faction, card_type, sub_type) for
+            faction in factions} for faction_type, factions in
+            faction_types.items()} for sub_type, faction_types in
+            subtypes.items()} for card_type, subtypes in self.curve.items()}
 
     def print_curve(self, faction_type, card_type='creature', sub_type=None):
         """Displays the curves for a faction type. Requires calculating curves
@@ -139,8 +614,83 @@ class Cube():
                                                 Style.RESET_ALL, num), end='')
             print()
 
-    def plot_curve(self, faction_type, faction, card_type='creature', sub_type=None):
-        """Plot the curve for the given parameters."""
+    def print_simulation(self, faction_type, drafts, card_type='creature',
+                         sub_type=None, packs=3, seed=None, processes=1):
+        """Displays the mean, and 5th to 95th percentile, of the cards of a
+        type playable by each faction of a type at each cost, in packs opened
+        in simulated drafts (see simulation)."""
+
+        summary = self.simulation(faction_type, card_type, sub_type,
+                                  packs).simulate(drafts, seed, processes)
+
+        subtype_string = ''
+        if sub_type is not None:
+            subtype_string = " ({})".format(sub_type)
+
+        print("{}Cards of type {}{} at each cost in {} packs, mean (5%-95%) "
+              "of {} drafts, in:{}".format(Style.BRIGHT, card_type,
+                                           subtype_string, packs, drafts,
+                                           Style.RESET_ALL))
+
+        for faction in sorted(summary):
+            print(faction.ljust(12), end='')
+            for mana, stats in summary[faction].items():
+                label = 'all' if mana is None else "{:.0f}".format(mana)
+                print("{}{}{}:{:.1f} ({}-{}) ".format(
+                    Style.BRIGHT, label, Style.RESET_ALL, stats.mean,
+                    stats.percentiles[0], stats.percentiles[-1]), end='')
+            print()
+
+    def print_pips(self, faction_type, card_type='creature', sub_type=None,
+                   deck_size=40, lands=17, probability=.9):
+        """Displays the colored pips of the cards of a type playable by each
+        faction of a type at each cost, and the colored sources a deck of
+        the faction needs to cast them all on curve (see pips.Pips). Pips
+        are not counted by subtype, so a sub_type given is only named as
+        ignored."""
+
+        pip_counts = self.counts.pips
+
+        subtype_string = ''
+        if sub_type is not None:
+            subtype_string = " (any subtype, not only {})".format(sub_type)
+
+        print("{}Colored pips of type {}{} at each cost in:{}".format(
+            Style.BRIGHT, card_type, subtype_string, Style.RESET_ALL))
+        for faction in sorted(mtg.Faction.get_factions(faction_type)):
+            print(faction.ljust(12), end='')
+            for mana, colors in sorted(pip_counts.curve(
+                    faction, card_type).items()):
+                print("{}{:.0f}{}:{} ".format(Style.BRIGHT, mana,
+                                              Style.RESET_ALL, " ".join(
+                                                  "{}{:g}".format(
+                                                      color.upper(),
+                                                      round(weight, 1))
+                                                  for color, weight in
+                                                  colors.items())), end='')
+            print()
+
+        print("{}Colored sources needed of {} lands in {} cards ({:.0%} on "
+              "curve) in:{}".format(Style.BRIGHT, lands, deck_size,
+                                    probability, Style.RESET_ALL))
+        for faction in sorted(mtg.Faction.get_factions(faction_type)):
+            print(faction.ljust(12), end='')
+            for color, sources in pip_counts.sources(
+                    faction, card_type, deck_size, lands,
+                    probability).items():
+                print("{}{}{}:{} ".format(
+                    Style.BRIGHT, color.upper(), Style.RESET_ALL,
+                    '>{}'.format(lands) if sources is None else sources),
+                    end='')
+            print()
+
+    def plot_curve(self, faction_type, faction, card_type='creature',
+                   sub_type=None, ax=None):
+        """Plot the curve for the given parameters, on the given
+        matplotlib Axes or else the current pyplot ones."""
+        if ax is None:
+            import matplotlib.pyplot as plt
+            ax = plt.gca()
 
         d = self.curve[card_type][sub_type][faction_type][faction].items()
 
@@ -149,12 +699,19 @@ class Cube():
 
         # Plot colors
         if faction in mtg.Faction.pc:
-            plt.plot(x, y, color=mtg.Faction.pc[faction], label=faction)
+            ax.plot(x, y, color=mtg.Faction.pc[faction], label=faction)
         else:
-            plt.plot(x, y, label=faction)
+            ax.plot(x, y, label=faction)
 
-    def show_curve_plots(self, faction_type, card_type='creature', sub_type=None):
-        """Display graphical plots of the desired curves."""
+    def plot_curves(self, faction_type, card_type='creature', sub_type=None,
+                    ax=None):
+        """Plot the curves of all factions of a type, with a title and legend,
+        on the given matplotlib Axes or else the current pyplot ones."""
+        if ax is None:
+            import matplotlib.pyplot as plt
+            ax = plt.gca()
+
+        self.update_curve(faction_type, card_type, sub_type)
 
         subtype_string = ''
 
@@ -162,19 +719,48 @@ class Cube():
             subtype_string = ", {}".format(sub_type)
 
         for faction in mtg.Faction.get_factions(faction_type):
-            self.plot_curve(faction_type, faction, card_type, sub_type)
-        plt.title("{} mana curves ({}{}) for "
-                  "{}".format(mtg.Faction.fsh[faction_type], card_type,
-                              subtype_string, self.csv_file))
-        plt.legend()
+            self.plot_curve(faction_type, faction, card_type, sub_type, ax)
+        ax.set_title("{} mana curves ({}{}) for "
+                     "{}".format(mtg.Faction.fsh[faction_type], card_type,
+                                 subtype_string, self.csv_file))
+        ax.legend()
+
+    def show_curve_plots(self, faction_type, card_type='creature', sub_type=None):
+        """Display graphical plots of the desired curves."""
+        import matplotlib.pyplot as plt
+
+        self.plot_curves(faction_type, card_type, sub_type)
         plt.show()
 
+    def render_curve_plots(self, faction_types, directory, card_type='creature',
+                           sub_type=None, plot_format='png'):
+        """Write plots of the curves of each faction type to image files (in
+        a format matplotlib supports, e.g. png or svg) in a directory,
+        without a display. Returns the paths of the files."""
+
+        fig = figure()
+        paths = list()
+
+        for faction_type in faction_types:
+            fig.clear()
+            self.plot_curves(faction_type, card_type, sub_type,
+                             ax=fig.add_subplot())
+
+            parts = [os.path.splitext(os.path.basename(self.csv_file))[0],
+                     faction_type, plot_names.get(card_type, card_type)]
+            if sub_type is not None:
+                parts.append(sub_type)
+            paths.append(os.path.join(directory, "{}.{}".format(
+                "-".join(parts), plot_format)))
+            fig.savefig(paths[-1], format=plot_format)
+
+        return paths
+
     def card_count(self, faction):
         """Returns the total number of cards playable in decks of only a
         particular faction. Duplicates count."""
-        conditions = [lambda card: faction in mtg.Faction.who_can_play(card.get('cost'))]
 
-        return sum(self.cards_matching_conditions(*conditions).values())
+        return self.counts.total(faction)
 
     def show_type_counts(self, faction_type, card_type='creature', sub_type=None):
         """Display cards of a particular type broken down by playability in
@@ -193,14 +779,9 @@ class Cube():
                                                          Style.RESET_ALL))
 
         for faction in sorted(faction_list):
-            cd = self.conditional_curve(lambda card: card_type in
-                                        card['types'], lambda card: faction in
-                                        mtg.Faction.
-                                        who_can_play(card.get('cost')), lambda
-                                        card: sub_type is None or sub_type in
-                                        card.get('subtypes'))
-
-            print("{:12}{}".format(faction, sum(cd.values())))
+            print("{:12}{}".format(faction, self.counts.total(faction,
+                                                              card_type,
+                                                              sub_type)))
 
     def show_card_counts(self, faction_type):
         """Display the total number of cards playable in decks of all factions
@@ -213,13 +794,254 @@ class Cube():
             print("{:12}{}".format(f, self.card_count(f)))
 
 
+def show_report(cube, faction_types, card_type='creature', sub_type=None,
+                plot=False):
+    """Display card counts and curves of a cube for each faction type."""
+
+    for faction_type in faction_types:
+        with timings.phase('report'):
+            cube.show_card_counts(faction_type)
+            cube.show_type_counts(faction_type, card_type, sub_type=sub_type)
+            cube.print_curve(faction_type, card_type=card_type,
+                             sub_type=sub_type)
+
+        if plot:
+            with timings.phase('plot'):
+                cube.show_curve_plots(faction_type, card_type=card_type,
+                                      sub_type=sub_type)
+
+
+def watch(cube, report, interval=.5, file=None):
+    """Updates the cube whenever its CSV file changes (see Cube.reload), then
+    prints the cards added and removed to file (standard output by default)
+    and calls report(). Runs until interrupted."""
+
+    mtime = os.stat(cube.csv_file).st_mtime
+    while True:
+        time.sleep(interval)
+        try:
+            changed = os.stat(cube.csv_file).st_mtime
+        except FileNotFoundError:
+            # Some editors save by replacing the file
+            continue
+        if changed == mtime:
+            continue
+        mtime = changed
+
+        start = time.perf_counter()
+        try:
+            with timings.phase('reload'):
+                delta = cube.reload()
+        except (OSError, csv.Error) as e:
+            logging.warning("Could not read %s: %s", cube.csv_file, e)
+            continue
+        except mtg.CardAPIError as e:
+            # The cube is left as it was until the file is saved again
+            logging.warning("Could not update %s: %s", cube.csv_file, e)
+            continue
+        cube.cards.save()
+
+        print("{}== {} changed: {} =={}".format(
+            Style.BRIGHT, cube.csv_file, ", ".join(
+                "{:+d} {}".format(num, name) for name, num in
+                sorted(delta.items())) or "no changes", Style.RESET_ALL),
+            file=file or sys.stdout)
+        report()
+        logging.info("Updated in %.1f ms", (time.perf_counter() - start) *
+                     1000)
+
+
+def cube_files(paths):
+    """Expands directories in a list of paths to the CSV files in them."""
+
+    files = list()
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, f) for f in os.listdir(path)
+                                if f.lower().endswith('.csv')))
+        else:
+            files.append(path)
+
+    return files
+
+
+def summarize(cube, faction_types, card_type='creature', sub_type=None):
+    """Returns the counts of a cube as { faction_type : { 'cards' | 'types' :
+    { faction : num }, 'curves' : { faction : curve } } }."""
+
+    summary = dict()
+    for faction_type in faction_types:
+        cube.update_curve(faction_type, card_type, sub_type)
+        factions = mtg.Faction.get_factions(faction_type)
+        summary[faction_type] = {
+            'cards': {f: cube.card_count(f) for f in factions},
+            'types': {f: cube.counts.total(f, card_type, sub_type) for f in
+                      factions},
+            'curves': cube.curve[card_type][sub_type][faction_type]}
+
+    return summary
+
+
+def analyze(csv_file, db_file, faction_types, card_type='creature',
+            sub_type=None, api_url='https://api.scryfall.com', plot_dir=None,
+            plot_format='png'):
+    """Analyzes one cube of a batch (see batch), whose card data must already
+    be in the card database, rendering plots of its curves to plot_dir if
+    given. Returns the printed report on the cube as a string, its counts
+    (see summarize), and its curves (Cube.curve), including those of any
+    card, and their totals (Cube.curve_totals)."""
+
+    cube = Cube(csv_file, db_file, api_url=api_url)
+
+    text = io.StringIO()
+    with contextlib.redirect_stdout(text):
+        show_report(cube, faction_types, card_type, sub_type)
+    summary = summarize(cube, faction_types, card_type, sub_type)
+    for faction_type in faction_types:
+        cube.update_curve(faction_type, mtg.any_type)
+
+    if plot_dir is not None:
+        cube.render_curve_plots(faction_types, plot_dir, card_type, sub_type,
+                                plot_format)
+
+    return text.getvalue(), summary, cube.curve, cube.curve_totals()
+
+
+def print_changes(old, new, card_type='creature', sub_type=None):
+    """Display the differences between the summaries of two cubes (see
+    analyze)."""
+
+    subtype_string = ''
+    if sub_type is not None:
+        subtype_string = " ({})".format(sub_type)
+
+    for faction_type in new:
+        print("{}Change in total cards in:{}".format(Style.BRIGHT,
+                                                     Style.RESET_ALL))
+        for f in sorted(new[faction_type]['cards']):
+            print("{:12}{:+d}".format(f, new[faction_type]['cards'][f] -
+                                      old[faction_type]['cards'][f]))
+
+        print("{}Change in cards of type {}{} per {} in:{}".format(
+            Style.BRIGHT, card_type, subtype_string,
+            mtg.Faction.fsh[faction_type], Style.RESET_ALL))
+        for f in sorted(new[faction_type]['types']):
+            print("{:12}{:+d}".format(f, new[faction_type]['types'][f] -
+                                      old[faction_type]['types'][f]))
+
+        print("{}Change in cards of type {}{} at each cost in:{}".format(
+            Style.BRIGHT, card_type, subtype_string, Style.RESET_ALL))
+        for f in sorted(new[faction_type]['curves']):
+            delta = Counter(new[faction_type]['curves'][f])
+            delta.subtract(old[faction_type]['curves'][f])
+            print(f.ljust(12), end='')
+            for mana, num in sorted(delta.items()):
+                if num:
+                    print("{}{:.0f}{}:{:+d} ".format(Style.BRIGHT, mana,
+                                                     Style.RESET_ALL, num),
+                          end='')
+            print()
+
+
+def batch(csv_files, db_file, faction_types, card_type='creature',
+          sub_type=None, processes=None, api_url='https://api.scryfall.com',
+          export_file=None, plot_dir=None, plot_format='png'):
+    """Analyzes many cubes at once. Card data for all of them is resolved
+    first, against the card database and then the API, and the cubes are
+    then analyzed in parallel by a pool of processes. Prints a report on
+    each cube in the order given, followed by its changes from the previous
+    one. The curves of all the cubes are exported to export_file if given
+    (see export.RowWriter), and plots of them rendered to plot_dir if given
+    (see Cube.render_curve_plots), also in parallel."""
+
+    names = set()
+    with timings.phase('read cube'):
+        for csv_file in csv_files:
+            names.update(read_cube(csv_file))
+
+    cards = mtg.Cards(db_file, api_url=api_url)
+    timings.cards = cards
+    with timings.phase('card data'):
+        try:
+            missing = cards.add_cards(sorted(names))
+        except mtg.CardAPIError as e:
+            exit(str(e))
+        cards.save()
+    if missing:
+        exit(str(mtg.CardsNotFoundError(missing)))
+
+    import multiprocessing
+    with timings.phase('analyze'), multiprocessing.Pool(processes) as pool:
+        results = pool.starmap(analyze, [(csv_file, db_file, faction_types,
+                                          card_type, sub_type, api_url,
+                                          plot_dir, plot_format) for
+                                         csv_file in csv_files])
+
+    if export_file is not None:
+        import export
+        with timings.phase('export'), export.RowWriter(export_file) as writer:
+            for csv_file, (_, _, curves, totals) in zip(csv_files,
+                                                          results):
+                writer.write(export.rows(csv_file, curves, totals))
+        if export_file == '-':
+            # The rows are the only output
+            return
+
+    previous = None
+    for csv_file, (text, summary, _, _) in zip(csv_files, results):
+        print("{}== {} =={}".format(Style.BRIGHT, csv_file, Style.RESET_ALL))
+        print(text, end='')
+        if previous is not None:
+            print("{}== {} -> {} =={}".format(Style.BRIGHT, previous[0],
+                                              csv_file, Style.RESET_ALL))
+            print_changes(previous[1], summary, card_type, sub_type)
+        previous = (csv_file, summary)
+
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='Curve analysis tool \
                                      for Magic: the Gathering cubes.')
 
-    parser.add_argument('cubefile', metavar='[FILE]', type=str,
-                        help='The cube file (cubetutor CSV export)')
+    parser.add_argument('cubefiles', metavar='[FILE]', type=str, nargs='*',
+                        help='The cube file (cubetutor CSV export), or - \
+                        for standard input. Given several files or a \
+                        directory of them, they are analyzed together and \
+                        compared.')
+
+    parser.add_argument('--db', metavar='file', dest='db', type=str,
+                        default=default_db, help='Card database shared by \
+                        all cubes (default: {})'.format(default_db))
+
+    parser.add_argument('--import-bulk', metavar='file', dest='bulk',
+                        type=str, default=None, help='Add the cards in a \
+                        Scryfall bulk data file to the card database, \
+                        replacing any already there')
+
+    parser.add_argument('--import-json', metavar='file', dest='json_files',
+                        type=str, nargs='+', default=[], help='Add the cards \
+                        in JSON card caches from older versions to the card \
+                        database')
+
+    parser.add_argument('--compact', action='store_true', help='Strip unused \
+                        fields from the cards in the card database')
+
+    parser.add_argument('--cache-dir', metavar='dir', dest='cache_dir',
+                        type=str, default=default_cache, help='Cache the \
+                        counts of each cube here, so that an unchanged cube \
+                        is analyzed again without counting its cards \
+                        (default: {})'.format(default_cache))
+
+    parser.add_argument('--no-cache', action='store_const', dest='cache_dir',
+                        const=None, help='Do not cache counts')
+
+    parser.add_argument('--clear-cache', action='store_true', help='Remove \
+                        every cached count')
+
+    parser.add_argument('--serve', metavar='port', dest='port', type=int,
+                        default=None, help='Run a server on localhost that \
+                        analyzes cubes posted to it, keeping card data in \
+                        memory (see server.py)')
 
     parser.add_argument('-t', metavar='type', dest='t', type=str, nargs='?',
                         default='creature', help='The card type \
@@ -230,6 +1052,12 @@ if __name__ == '__main__':
                         help='The card subtype \
                         to calculate curves for (default: none)')
 
+    parser.add_argument('-q', '--query', metavar='expression',
+                        dest='queries', type=str, action='append',
+                        default=[], help='Show the cards matching a filter \
+                        expression, e.g. "type:creature sub:elf cmc<=3 \
+                        faction:golgari", and their curve (see query.py)')
+
     parser.add_argument('-c', dest='faction_types', const='c',
                         action='append_const', default=[], help='Calculate \
                         curves for colors')
@@ -253,6 +1081,56 @@ if __name__ == '__main__':
     parser.add_argument('--plot', action='store_true',
                         help='Display plots of generated curves')
 
+    parser.add_argument('--plot-dir', metavar='dir', dest='plot_dir',
+                        type=str, default=None, help='Write plots of \
+                        generated curves to image files in a directory, \
+                        without displaying them')
+
+    parser.add_argument('--plot-format', metavar='format', dest='plot_format',
+                        type=str, default='png', help='Image format of \
+                        plots written with --plot-dir, e.g. png or svg \
+                        (default: png)')
+
+    parser.add_argument('--pips', action='store_true', help='Show the \
+                        colored pips of cards at each cost, and the colored \
+                        sources needed to cast them on curve, for each \
+                        faction; of the type given by -t, but of any \
+                        subtype')
+
+    parser.add_argument('--simulate', metavar='drafts', dest='drafts',
+                        type=int, default=None, help='Also show the curves \
+                        of cards in the packs opened in a number of \
+                        simulated drafts (requires NumPy)')
+
+    parser.add_argument('--packs', metavar='N', dest='packs', type=int,
+                        default=3, help='Packs of 15 cards opened in each \
+                        simulated draft (default: 3)')
+
+    parser.add_argument('--seed', metavar='N', dest='seed', type=int,
+                        default=None, help='Random seed for --simulate')
+
+    parser.add_argument('--export', metavar='file', dest='export',
+                        type=str, default=None, help='Write the curves, and \
+                        those of all cards, to a file as rows of JSON Lines \
+                        (.jsonl), CSV (.csv) or Parquet (.parquet); - for \
+                        JSON Lines on standard output')
+
+    parser.add_argument('--watch', action='store_true', help='Keep running, \
+                        and display the results again whenever the cube file \
+                        changes')
+
+    parser.add_argument('-j', '--jobs', metavar='N', dest='jobs', type=int,
+                        default=None, help='Number of processes to analyze \
+                        several cubes with (default: one per CPU)')
+
+    parser.add_argument('--timings', action='store_true', help='Show the \
+                        time taken by each phase of the run, and where card \
+                        data came from, on standard error')
+
+    parser.add_argument('--profile', metavar='file', dest='profile', type=str,
+                        default=None, help='Write cProfile statistics of the \
+                        run to a file (see the pstats module)')
+
     parser.add_argument('-v', '--verbose', action='store_const', dest="loglevel",
                         const=logging.INFO, default=logging.WARNING,
                         help='Generate verbose output')
@@ -267,16 +1145,162 @@ if __name__ == '__main__':
     logger = logging.getLogger()
     logging.basicConfig(level=args.loglevel, format='%(asctime)s - %(levelname)s - %(message)s')
 
-    # colorama
-    init()
+    if not args.cubefiles and args.bulk is None and not args.json_files \
+            and not args.compact and not args.clear_cache \
+            and args.port is None:
+        parser.error("a cube file is required")
+
+    # Killed, still save card data and write reports at exit
+    signal.signal(signal.SIGTERM, lambda signum, frame: exit(1))
+
+    if args.profile is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+
+        def write_profile():
+            profiler.disable()
+            profiler.dump_stats(args.profile)
 
-    thecube = Cube(args.cubefile, "{}.json".
-                   format(os.path.splitext(args.cubefile)[0]))
+        # Registered first, so it runs after everything else at exit
+        atexit.register(write_profile)
+        profiler.enable()
 
-    for faction_type in args.faction_types:
-        thecube.show_card_counts(faction_type)
-        thecube.show_type_counts(faction_type, args.t, sub_type=args.subtype)
-        thecube.print_curve(faction_type, card_type=args.t, sub_type=args.subtype)
+    if args.timings:
+        atexit.register(timings.report)
 
-        if args.plot:
-            thecube.show_curve_plots(faction_type, card_type=args.t, sub_type=args.subtype)
+    if args.queries:
+        import query
+        for expression in args.queries:
+            try:
+                query.compile(expression)
+            except ValueError as e:
+                parser.error(e)
+
+    # colorama
+    if sys.stdout.isatty():
+        import colorama
+        colorama.init()
+        Style = colorama.Style
+
+    if os.path.dirname(args.db):
+        os.makedirs(os.path.dirname(args.db), exist_ok=True)
+    store = mtg.CardStore(args.db)
+
+    if args.bulk is not None:
+        print("Indexed {} cards from {}".format(store.import_bulk(args.bulk),
+                                                args.bulk))
+
+    for json_file in args.json_files:
+        print("Imported {} cards from {}".format(store.import_json(json_file),
+                                                 json_file))
+
+    if args.compact:
+        size = os.path.getsize(args.db)
+        store.compact()
+        print("Compacted {}: {} to {} bytes".format(args.db, size,
+                                                   os.path.getsize(args.db)))
+
+    results = None
+    if args.cache_dir is not None:
+        import cache
+        results = cache.ResultCache(args.cache_dir)
+
+    if args.clear_cache:
+        if results is not None:
+            results.invalidate()
+            print("Cleared {}".format(args.cache_dir))
+
+    if args.port is not None:
+        import server
+        httpd = server.make_server(mtg.Cards(store=store), port=args.port)
+        print("Serving on http://127.0.0.1:{}".format(args.port))
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        exit()
+
+    if not args.cubefiles:
+        exit()
+
+    if args.plot_dir is not None:
+        os.makedirs(args.plot_dir, exist_ok=True)
+
+    csv_files = cube_files(args.cubefiles)
+    if '-' in csv_files and (len(csv_files) > 1 or args.watch):
+        parser.error("standard input can only be read alone, and not "
+                     "watched")
+    if len(csv_files) > 1 or os.path.isdir(args.cubefiles[0]):
+        unsupported = [option for option, given in (
+            ('-q', args.queries), ('--pips', args.pips),
+            ('--simulate', args.drafts is not None), ('--watch', args.watch),
+            ('--plot', args.plot),
+            ('--cache-dir', args.cache_dir not in (default_cache, None)))
+            if given]
+        if unsupported:
+            parser.error("{} can only be used with one cube".format(
+                ", ".join(unsupported)))
+        store.close()
+        batch(csv_files, args.db, args.faction_types, args.t, args.subtype,
+              processes=args.jobs, export_file=args.export,
+              plot_dir=args.plot_dir, plot_format=args.plot_format)
+        exit()
+
+    try:
+        thecube = Cube(csv_files[0], args.db, store=store, cache=results)
+    except (mtg.CardAPIError, mtg.CardsNotFoundError) as e:
+        exit(str(e))
+    timings.cards = thecube.cards
+
+    def text_report(plot):
+        show_report(thecube, args.faction_types, args.t, args.subtype,
+                    plot=plot)
+
+        with timings.phase('query'):
+            for expression in args.queries:
+                thecube.print_query(expression)
+
+        if args.pips:
+            with timings.phase('pips'):
+                for faction_type in args.faction_types:
+                    thecube.print_pips(faction_type, args.t, args.subtype)
+
+        if args.drafts is not None:
+            with timings.phase('simulate'):
+                for faction_type in args.faction_types:
+                    thecube.print_simulation(faction_type, args.drafts,
+                                             args.t, args.subtype, args.packs,
+                                             args.seed,
+                                             args.jobs or os.cpu_count())
+
+    def report():
+        if args.export == '-':
+            # The rows are the only output
+            with contextlib.redirect_stdout(io.StringIO()):
+                text_report(plot=False)
+        else:
+            text_report(plot=args.plot)
+
+        if args.plot_dir is not None:
+            with timings.phase('plot'):
+                thecube.render_curve_plots(args.faction_types, args.plot_dir,
+                                           args.t, args.subtype,
+                                           args.plot_format)
+
+        if args.export is not None:
+            import export
+            with timings.phase('export'):
+                for faction_type in args.faction_types:
+                    thecube.update_curve(faction_type, mtg.any_type)
+                with export.RowWriter(args.export) as writer:
+                    writer.write(export.cube_rows(thecube))
+
+    report()
+
+    if args.watch:
+        try:
+            # Keep exported rows the only output to standard output
+            watch(thecube, report, file=sys.stderr if args.export == '-'
+                  else None)
+        except KeyboardInterrupt:
+            pass
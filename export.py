@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""Export of mana curves as tidy rows, in JSON Lines, CSV or Parquet."""
+
+import csv
+import json
+import os.path
+import sys
+
+fields = ('cube', 'faction_type', 'faction', 'type', 'subtype', 'cmc',
+          'count')
+
+
+def rows(cube_name, curves, totals=None):
+    """Yields a dictionary with the given fields for every cmc of every curve
+    in a structure of the form of Cube.curve, i.e. { type : { subtype :
+    { faction type : { faction : curve } } } }. Type None stands for any
+    nonland permanent and mtg.any_type for any card. Given totals of the
+    same form with the number of cards of each curve (see
+    Cube.curve_totals), each curve is followed by a row of cmc None with
+    that number: the card counts shown by cubealyzer are those of type
+    mtg.any_type. They need not be the sums of the other rows, since each
+    face of a card that has several counts at its own cmc."""
+
+    for card_type, subtypes in curves.items():
+        for sub_type, faction_types in subtypes.items():
+            for faction_type, factions in faction_types.items():
+                for faction, curve in sorted(factions.items()):
+                    row = {'cube': cube_name, 'faction_type': faction_type,
+                           'faction': faction, 'type': card_type,
+                           'subtype': sub_type}
+                    for cmc, count in sorted(curve.items()):
+                        yield dict(row, cmc=cmc, count=count)
+                    if totals is not None:
+                        count = totals[card_type][sub_type][faction_type][
+                            faction]
+                        if count:
+                            yield dict(row, cmc=None, count=count)
+
+
+def cube_rows(cube):
+    """Rows (see rows) of the curves calculated so far for a cube, and of
+    their totals."""
+    return rows(cube.csv_file, cube.curve, cube.curve_totals())
+
+
+class RowWriter():
+    """Writes rows to a file, or standard output if the path is '-', as they
+    come. The format is one of formats, by default the one named by the
+    file's extension (JSON Lines if there is none). Parquet requires
+    pyarrow, and is written a row group of batch_size rows at a time."""
+
+    formats = ('jsonl', 'csv', 'parquet')
+
+    batch_size = 65536
+
+    def __init__(self, path, format=None):
+
+        if format is None:
+            ext = os.path.splitext(path)[1].lstrip('.').lower()
+            format = {'': 'jsonl', 'json': 'jsonl', 'ndjson': 'jsonl'}.get(
+                ext, ext)
+        if format not in self.formats:
+            raise ValueError("Unknown export format: {}".format(format))
+
+        self.path = path
+        self.format = format
+        self.buffer = list()
+
+        if format == 'parquet':
+            import pyarrow
+            import pyarrow.parquet
+            self.schema = pyarrow.schema([
+                ('cube', pyarrow.string()),
+                ('faction_type', pyarrow.string()),
+                ('faction', pyarrow.string()),
+                ('type', pyarrow.string()),
+                ('subtype', pyarrow.string()),
+                ('cmc', pyarrow.float64()),
+                ('count', pyarrow.int64())])
+            self.file = pyarrow.parquet.ParquetWriter(path, self.schema)
+            return
+
+        if path == '-':
+            self.file = sys.stdout
+        else:
+            self.file = open(path, 'w', newline='')
+
+        if format == 'csv':
+            self.csv = csv.DictWriter(self.file, fields)
+            self.csv.writeheader()
+
+    def write(self, rows):
+        """Writes an iterable of rows."""
+
+        if self.format == 'jsonl':
+            for row in rows:
+                self.file.write(json.dumps(row))
+                self.file.write('\n')
+        elif self.format == 'csv':
+            self.csv.writerows(rows)
+        else:
+            for row in rows:
+                self.buffer.append(row)
+                if len(self.buffer) >= self.batch_size:
+                    self.flush()
+
+    def flush(self):
+        """Writes any buffered rows to a Parquet file."""
+
+        if not self.buffer:
+            return
+
+        import pyarrow
+        self.file.write_table(pyarrow.Table.from_pylist(self.buffer,
+                                                        schema=self.schema))
+        self.buffer = list()
+
+    def close(self):
+        if self.format == 'parquet':
+            self.flush()
+            self.file.close()
+        elif self.file is sys.stdout:
+            self.file.flush()
+        else:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
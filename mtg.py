@@ -2,11 +2,17 @@
 
 import re
 import os
+import sys
 import json
+import sqlite3
 import time
+import random
 import functools
+import collections
 import logging
-import requests
+import threading
+import uuid
+import concurrent.futures
 
 
 class Faction:
@@ -130,44 +136,67 @@ class Faction:
     fsh = {'c': 'color', 'g': 'guild', 's': 'shard', 'w': 'wedge', 'n':
            'nephilim'}
 
-    @functools.lru_cache(maxsize=200)
-    def who_can_play(cost):
-        # Start by assuming anyone can play anything
-        can_play = set(Faction.all_factions)
-        costs = re.findall('([^{^}]+)', cost)
-
-        for subcost in costs:
-            # H = half (Little Girl)
-            subcost = subcost.replace("H", "")
-            # Colorless (eldrazi) mana
-            if subcost == 'C':
-                can_play = set()
-
-            elif re.search(r'\d+|P|X', subcost) is not None:
-                logging.debug("Anyone can pay this subcost, continuing")
-                continue
+    # color bits, for 5-bit color masks
+    cb = {c[0]: 1, c[1]: 2, c[2]: 4, c[3]: 8, c[4]: 16}
+    cb_letters = 'WUBRG'
 
-            # hybrid mana
-            elif '/' in subcost:
-                hybrid_colors = set([Faction.colorname(h) for h in
-                                     subcost.split('/')])
+    # Faction i is bit i of a faction mask (a set of factions as an int)
+    bit = {f: 1 << i for i, f in enumerate(c + g + s + w + n)}
+    everyone = (1 << len(bit)) - 1
 
-                # who can pay this particular subcost?
-                can_pay_hybrid = set()
-                for color in hybrid_colors:
-                    can_pay_hybrid.update(Faction.member_of(color))
+    # Filled in below the class: the color mask of each faction (cm), the
+    # factions whose colors include each of the 32 color masks
+    # (playable_by), and the factions each faction is a member of
+    # (membership), all as masks.
+    cm = dict()
+    playable_by = tuple()
+    membership = dict()
 
-                can_play.intersection_update(can_pay_hybrid)
+    def who_can_play(cost):
+        """Returns the frozenset of names of the factions that can pay the
+        given mana cost (or that the named faction is a member of)."""
+        return Faction.names(Faction.playable_mask(cost))
+
+    @functools.lru_cache(maxsize=None)
+    def playable_mask(cost):
+        """Like who_can_play, but returns a faction mask. The cost may be a
+        string or a ManaCost."""
+
+        if not isinstance(cost, ManaCost):
+            cost = ManaCost.parse(cost)
+
+        # Colorless (eldrazi) mana
+        if cost.colorless:
+            return 0
+
+        # Start by assuming anyone can play anything. Generic, X and
+        # phyrexian mana can be paid by anyone, so only the colored symbols
+        # (including half mana, as on Little Girl) narrow this down.
+        can_play = Faction.everyone
+        for color in cost.colored + cost.half + cost.other:
+            can_play &= Faction.membership.get(Faction.colorname(color), 0)
+
+        # hybrid mana: who can pay this particular subcost?
+        for options in cost.hybrid:
+            if any(option.isdigit() for option in options):
+                continue
+            can_pay_hybrid = 0
+            for option in options:
+                can_pay_hybrid |= Faction.membership.get(
+                    Faction.colorname(option), 0)
+            can_play &= can_pay_hybrid
 
-            # Single color
-            else:
-                logging.debug("Subcost %s payable by %s", subcost,
-                              Faction.member_of(subcost))
+        return can_play
 
-                subcost = Faction.colorname(subcost)
-                can_play.intersection_update(Faction.member_of(subcost))
+    def can_play(faction, cost):
+        """Whether the named faction can pay the given mana cost."""
+        return bool(Faction.bit[faction] & Faction.playable_mask(cost))
 
-        return can_play
+    @functools.lru_cache(maxsize=None)
+    def names(mask):
+        """Returns the frozenset of names of the factions in a faction
+        mask."""
+        return frozenset(f for f, b in Faction.bit.items() if mask & b)
 
     def member_of(faction):
         """Takes the name of a faction - a color, guild, shard, wedge, or
@@ -177,145 +206,779 @@ class Faction:
 
         faction = Faction.colorname(faction)
 
-        # this color is a member of these shards
-        m = {k for k, v in Faction.sm.items() if faction in v}
+        # always a member of itself
+        if faction not in Faction.membership:
+            return frozenset({faction})
+
+        return Faction.names(Faction.membership[faction])
+
+    def colorname(name):
+        """Convert color names from shorthand."""
+        name = name.lower()
+        if name in Faction.csh:
+            name = Faction.csh.get(name)  # color shorthand (w,b,r,g,u)
+        return name
+
 
-        # this color is a member of these guilds
-        m = set.union(m, {k for k, v in Faction.gm.items() if faction in v})
+class ManaCost(collections.namedtuple('ManaCost', ['generic', 'x',
+                                                    'colorless', 'colored',
+                                                    'hybrid', 'phyrexian',
+                                                    'half', 'other'])):
+    """A mana cost broken down by kind of symbol: the generic amount, the
+    number of X (or Y, Z) symbols and colorless ({C}) symbols, and tuples of
+    the colored pips, hybrid and phyrexian symbols (each a tuple of the
+    alternatives, e.g. ('w', 'u') or ('2', 'w'), or of the colors of a
+    phyrexian symbol, empty for {P}), half mana pips ({HW}) and anything
+    unrecognized. Colors are given by their letter."""
+
+    __slots__ = ()
+
+    # Braces are optional, so that a bare name (e.g. 'orzhov') parses too
+    symbol_re = re.compile('[^{}]+')
+
+    @functools.lru_cache(maxsize=None)
+    def parse(cost):
+        """Returns the ManaCost for a cost string such as '{2}{W/U}{B}'."""
+
+        generic = x = colorless = 0
+        colored, hybrid, phyrexian, half, other = [], [], [], [], []
+
+        for symbol in ManaCost.symbol_re.findall(cost or ''):
+            if symbol.isdigit():
+                generic += int(symbol)
+            elif symbol in ('X', 'Y', 'Z'):
+                x += 1
+            elif symbol == 'C':
+                colorless += 1
+            elif symbol == 'P':
+                # Phyrexian mana of no color, paid with life or generic mana
+                phyrexian.append(())
+            elif '/' in symbol:
+                options = tuple(o.lower() for o in symbol.split('/'))
+                if 'p' in options:
+                    phyrexian.append(tuple(o for o in options if o != 'p'))
+                else:
+                    hybrid.append(options)
+            elif len(symbol) == 2 and symbol[0] == 'H':
+                half.append(symbol[1].lower())
+            elif symbol.upper() in Faction.cb_letters:
+                colored.append(symbol.lower())
+            else:
+                other.append(symbol)
 
-        # this color is a member of these wedges
-        m = set.union(m, {k for k, v in Faction.wm.items() if faction in v})
+        return ManaCost(generic, x, colorless, tuple(colored), tuple(hybrid),
+                        tuple(phyrexian), tuple(half), tuple(other))
+
+    def load(data):
+        """Rebuild a ManaCost from its JSON form (a list). Costs saved by
+        versions that did not recognize {P} have it in other."""
+        generic, x, colorless, colored, hybrid, phyrexian, half, other = data
+        phyrexian = [tuple(p) for p in phyrexian]
+        if 'P' in other:
+            phyrexian.extend(() for symbol in other if symbol == 'P')
+            other = [symbol for symbol in other if symbol != 'P']
+        return ManaCost(generic, x, colorless, tuple(colored),
+                        tuple(tuple(h) for h in hybrid), tuple(phyrexian),
+                        tuple(half), tuple(other))
+
+
+def card_mana(card):
+    """Returns the ManaCost of card data, parsing its cost if it was stored
+    without one."""
+    return card.get('mana') or ManaCost.parse(card.get('cost'))
+
+
+# Colors of each faction
+Faction.cm.update({color: b for color, b in Faction.cb.items()})
+for table in (Faction.gm, Faction.sm, Faction.wm, Faction.nm):
+    for faction, colors in table.items():
+        Faction.cm[faction] = sum(Faction.cb[color] for color in colors)
+
+# Factions that can play cards requiring each combination of colors
+Faction.playable_by = tuple(sum(Faction.bit[f] for f, m in Faction.cm.items()
+                                if m & required == required)
+                            for required in range(32))
+
+# A color is a member of every faction that includes it; other factions
+# are members of those that list them in the inclusion tables.
+for faction in Faction.bit:
+    if faction in Faction.cb:
+        Faction.membership[faction] = Faction.playable_by[Faction.cb[faction]]
+    else:
+        Faction.membership[faction] = Faction.bit[faction]
+        for table in (Faction.sgm, Faction.wgm, Faction.ngm, Faction.nsm,
+                      Faction.nwm):
+            for k, v in table.items():
+                if faction in v:
+                    Faction.membership[faction] |= Faction.bit[k]
 
-        # this color is a member of these nephilim
-        m = set.union(m, {k for k, v in Faction.nm.items() if faction in v})
 
-        # this guild is a member of these shards
-        m = set.union(m, {k for k, v in Faction.sm.items() if faction in
-                          Faction.sgm[k]})
+# Card types that make a card a nonland permanent
+permanent_types = frozenset({'creature', 'enchantment', 'artifact',
+                             'planeswalker'})
+
+# Stands for any card type where a type is expected
+any_type = '*'
 
-        # this guild is a member of these wedges
-        m = set.union(m, {k for k, v in Faction.wm.items() if faction in
-                          Faction.wgm[k]})
+# The card data cubealyzer uses; everything else from Scryfall is dropped
+card_fields = ('name', 'cost', 'mana', 'cmc', 'types', 'subtypes', 'faces')
 
-        # this guild is a member of these nephilim
-        m = set.union(m, {k for k, v in Faction.ngm.items() if faction in
-                          Faction.ngm[k]})
+# Changed whenever the card data in a CardStore changes form, so that data
+# saved in an older form is brought up to date (see CardStore.migrate)
+card_schema = 2
+
+# The fields of each face of a card, in 'faces'
+face_fields = ('name', 'cost', 'mana', 'cmc', 'types', 'subtypes')
 
-        # this shard is a member of these nephilim
-        m = set.union(m, {k for k, v in Faction.nsm.items() if faction in
-                          Faction.nsm[k]})
+# Layouts of cards each of whose faces can be cast, or played, on its own
+# (https://scryfall.com/docs/api/layouts). Other multi-faced cards, such as
+# transforming and flip cards, are cast by their front face only.
+face_layouts = frozenset({'split', 'modal_dfc', 'adventure'})
 
-        # this wedge is a member of these nephilim
-        m = set.union(m, {k for k, v in Faction.nwm.items() if faction in
-                          Faction.nwm[k]})
 
-        # always a member of itself
-        m = set.union(m, {faction})
+def slim_card(card, retain=()):
+    """Returns a copy of card data with only card_fields and the fields named
+    in retain, parsing the cost if that has not been done."""
+    slim = {k: card[k] for k in card_fields + tuple(retain) if k in card}
+    if 'mana' not in slim and 'cost' in slim:
+        slim['mana'] = ManaCost.parse(slim['cost'])
+    return slim
 
-        return m
 
-    def colorname(name):
-        """Convert color names from shorthand."""
-        name = name.lower()
-        if name in Faction.csh:
-            name = Faction.csh.get(name)  # color shorthand (w,b,r,g,u)
-        return name
+def mana_value(mana):
+    """Returns the mana value (converted mana cost) of a ManaCost, counting
+    X as zero."""
+    return (mana.generic + mana.colorless + len(mana.colored) +
+            sum(2 if '2' in options else 1 for options in mana.hybrid) +
+            len(mana.phyrexian) + .5 * len(mana.half))
+
+
+def parse_face(data):
+    """Parse the cost and type line of a Scryfall card or card face into
+    'cost', 'mana', 'types' and 'subtypes', added to a copy of it."""
+
+    card = dict(data)
+
+    # Compatibility with previous Deckbrew format
+    card['cost'] = card.get('mana_cost', '')
+    card['mana'] = ManaCost.parse(card['cost'])
+
+    # Parse typeline
+    typeline = card['type_line'].lower()
+
+    # Parse card type into types (including supertype) and creature type
+    # A set might make more logical sense, but for now easier
+    # to use lists with default JSON encoder.
+    # Cover unlikely event of an empty typeline
+    card['types'] = list()
+
+    if '—' in typeline:
+        card['types'] = typeline.split('—', 1)[0].strip().split(' ')
+        card['subtypes'] = typeline.split('—', 1)[1].strip().split(' ')
+    else:
+        card['types'] = typeline.split(' ')
+        card['subtypes'] = list()
+
+    logging.debug("%s\n\tCost: %s\n\t%s\n\t%s %s", card.get('name'),
+                  card['cost'], Faction.who_can_play(card['cost']),
+                  card['types'], card['subtypes'])
+
+    return card
+
+
+def parse_card(data, retain=()):
+    """Reduce a Scryfall card object to the form kept in the card database:
+    the cost and type line are parsed into 'cost', 'types' and 'subtypes'.
+    Multi-faced cards are described by their front face and the global cmc,
+    and cards of face_layouts also keep each face, with its own cost, types
+    and cmc, in 'faces' (see card_faces). Only those fields, 'name', 'cmc'
+    and any fields named in retain are kept."""
+
+    card = dict(data)
+    faces = card.get('card_faces')
+
+    if faces:
+        # Use the global cmc; other card details from front face
+        card = dict(faces[0], cmc=card.get('cmc', 0))
+
+    card = parse_face(card)
+
+    if faces and data.get('layout') in face_layouts:
+        card['faces'] = list()
+        for face in faces:
+            face = parse_face(face)
+            face['cmc'] = float(face.get('cmc', mana_value(face['mana'])))
+            card['faces'].append({k: face[k] for k in face_fields})
+
+    return slim_card(card, retain)
+
+
+def card_faces(card):
+    """Returns the faces of card data that can each be cast (see
+    face_layouts), or just the card itself if it has one such face. Each
+    has a 'name', 'cost', 'mana', 'cmc', 'types' and 'subtypes'."""
+    return card.get('faces') or (card,)
+
+
+def load_card(text):
+    """Decode card data stored as JSON."""
+    card = json.loads(text)
+    if 'mana' in card:
+        card['mana'] = ManaCost.load(card['mana'])
+    for face in card.get('faces', ()):
+        face['mana'] = ManaCost.load(face['mana'])
+    return card
+
+
+class CardAPIError(Exception):
+    """Card data could not be had from the API: it could not be reached, or
+    answered with an error."""
+
+
+class CardsNotFoundError(Exception):
+    """Cards are unknown to the API. Their names are in names."""
+
+    def __init__(self, names):
+        super().__init__(list(names))
+        self.names = self.args[0]
+
+    def __str__(self):
+        return "Cards not found in API: {}".format(", ".join(self.names))
+
+
+class TokenBucket():
+    """Thread-safe token bucket shared by the workers fetching card data.
+    Tokens accrue at rate per second up to capacity; each request takes one.
+    A rate of zero disables limiting."""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        # Nobody may take a token before this time (see hold)
+        self.resume = 0
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Wait for a token and take it. Returns the time spent waiting."""
+
+        waited = 0
+        while self.rate:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens +
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.resume and self.tokens >= 1:
+                    self.tokens -= 1
+                    break
+                delay = max(self.resume - now, (1 - self.tokens) / self.rate)
+            time.sleep(delay)
+            waited += delay
+        return waited
+
+    def hold(self, seconds):
+        """Stop handing out tokens for the given number of seconds, e.g. when
+        the API has asked us to back off."""
+        with self.lock:
+            self.resume = max(self.resume, time.monotonic() + seconds)
+
+
+def iter_json_array(json_file, chunk_size=1 << 20):
+    """Yield the elements of a top-level JSON array one at a time, reading
+    the file in chunks rather than all at once."""
+
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    started = False
+    eof = False
+
+    while True:
+        # Skip whitespace and separators between elements, and the opening
+        # bracket of the array itself; any later one starts an element
+        while pos < len(buf) and (buf[pos] in ' \t\r\n,' or
+                                  buf[pos] == '[' and not started):
+            if buf[pos] == '[':
+                started = True
+            pos += 1
+
+        if pos < len(buf) and buf[pos] == ']' and started:
+            return
+
+        if pos < len(buf):
+            try:
+                element, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            else:
+                # Complete once followed by a separator: a number cut off
+                # by the end of a chunk (e.g. '-6.5e') still parses
+                if eof or (end < len(buf) and buf[end] in ' \t\r\n,]'):
+                    pos = end
+                    yield element
+                    continue
+        elif eof:
+            return
+
+        # Need more data: drop what has been consumed and read on
+        chunk = json_file.read(chunk_size)
+        eof = not chunk
+        buf = buf[pos:] + chunk
+        pos = 0
+
+
+class CardStore():
+    """Card data indexed by name in an SQLite file, read one card at a time
+    as needed. One store can be shared by any number of cubes. It can also be
+    built from a Scryfall bulk data file (see import_bulk) so that cubes can
+    be analyzed without network access."""
+
+    # Scryfall objects that are not cards anyone would put in a cube
+    skip_layouts = {'token', 'double_faced_token', 'emblem', 'art_series',
+                    'vanguard', 'scheme', 'planar'}
+
+    def __init__(self, path):
+        self.path = path
+        self.open()
+
+    def open(self):
+        # Used by one thread at a time, though not always the one that
+        # opened it (see cubealyzer.stream_cube)
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        # Each commit appends to a write-ahead log, so an interrupted write
+        # loses at most that transaction and never corrupts the database
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS cards "
+                          "(name TEXT PRIMARY KEY COLLATE NOCASE, "
+                          "data TEXT NOT NULL) WITHOUT ROWID")
+        # Which store this is, how many times its cards have changed (see
+        # version), and the card_schema of their data. Stores saved before
+        # the schema was recorded have the first one.
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta "
+                              "(key TEXT PRIMARY KEY, value) WITHOUT ROWID")
+            self.conn.execute("INSERT OR IGNORE INTO meta VALUES ('id', ?)",
+                              (uuid.uuid4().hex,))
+            self.conn.execute("INSERT OR IGNORE INTO meta VALUES "
+                              "('changes', 0)")
+            self.conn.execute("INSERT OR IGNORE INTO meta VALUES "
+                              "('schema', ?)",
+                              (1 if len(self) else card_schema,))
+            schema = self.conn.execute("SELECT value FROM meta WHERE key = "
+                                       "'schema'").fetchone()[0]
+            if schema < card_schema:
+                self.migrate(schema)
+
+    def migrate(self, schema):
+        """Bring card data saved with an older card_schema up to date, as
+        part of the transaction opening the store. Cards whose data cannot
+        be updated are dropped, to be downloaded again when next needed.
+
+        Schema 1 kept only the front face of multi-faced cards. Those saved
+        with their full Scryfall data (see compact) are parsed again. Others
+        can only be told apart from single-faced cards by being saved under
+        their full name, with the same data under each face name. One saved
+        under the name of a face alone keeps its front face until the card
+        is downloaded again or imported from bulk data (see import_bulk)."""
+
+        if schema < 2:
+            self.conn.execute("DELETE FROM cards WHERE data IN (SELECT data "
+                              "FROM cards WHERE name LIKE '% // %' AND data "
+                              "NOT LIKE '%\"card_faces\":%')")
+
+            rows = self.conn.execute("SELECT name, data FROM cards WHERE "
+                                     "data LIKE '%\"card_faces\":%'")
+            updated = list()
+            for name, data in rows.fetchall():
+                card = json.loads(data)
+                if card.get('card_faces') and 'layout' in card:
+                    updated.append((json.dumps(dict(card, **parse_card(card))),
+                                    name))
+            self.conn.executemany("UPDATE cards SET data = ? WHERE name = ?",
+                                  updated)
+
+        logging.info("Updated card data in %s to schema %d", self.path,
+                     card_schema)
+        self.conn.execute("UPDATE meta SET value = ? WHERE key = 'schema'",
+                          (card_schema,))
+        self.changed()
+
+    def version(self):
+        """Returns a string that identifies the store and the card data in
+        it, and changes whenever any card is added, replaced or stripped."""
+        meta = dict(self.conn.execute("SELECT key, value FROM meta"))
+        return "{}:{}".format(meta['id'], meta['changes'])
+
+    def changed(self):
+        """Count a change to the cards in the store (see version), as part
+        of the transaction making it."""
+        self.conn.execute("UPDATE meta SET value = value + 1 WHERE key = "
+                          "'changes'")
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM cards").fetchone()[0]
+
+    def get(self, name, default=None):
+        row = self.conn.execute("SELECT data FROM cards WHERE name = ?",
+                                (name,)).fetchone()
+        return load_card(row[0]) if row else default
+
+    def lookup(self, names):
+        """Returns a dict of card data for those of the given names that are
+        in the store. Names are matched case-insensitively."""
+
+        names = list(names)
+        found = dict()
+        # Stay well under SQLite's limit on query parameters
+        for i in range(0, len(names), 500):
+            batch = names[i:i + 500]
+            rows = self.conn.execute(
+                "SELECT name, data FROM cards WHERE name IN ({})".format(
+                    ','.join('?' * len(batch))), batch)
+            found.update((name.lower(), data) for name, data in rows)
+
+        return {name: load_card(found[name.lower()]) for name in names if
+                name.lower() in found}
+
+    def upsert(self, cards):
+        """Add or replace the given { name : card data } in the store."""
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO cards VALUES (?, ?)",
+                                  ((name, json.dumps(card)) for name, card in
+                                   cards.items()))
+            self.changed()
+
+    def import_json(self, json_path, retain=()):
+        """Import a card database file written by earlier versions of
+        cubealyzer (one JSON object per cube), keeping only the fields in
+        card_fields (and retain). Cards already in the store are kept.
+        Returns the number of cards in the file."""
+
+        with open(json_path, 'r') as db_file:
+            cards = json.loads(db_file.read())
+
+        with self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO cards VALUES (?, ?)",
+                                  ((name, json.dumps(slim_card(card, retain)))
+                                   for name, card in cards.items()))
+            self.changed()
+
+        return len(cards)
+
+    def compact(self, retain=()):
+        """Strip every card in the store down to card_fields (and retain),
+        e.g. after downloading full Scryfall data with an older version, and
+        give the space back to the file system. The compacted database is
+        written to a new file that then replaces the old one, so the store
+        is never left half-compacted."""
+
+        with self.conn:
+            rows = self.conn.execute("SELECT name, data FROM cards").fetchall()
+            self.conn.executemany("UPDATE cards SET data = ? WHERE name = ?",
+                                  ((json.dumps(slim_card(load_card(data),
+                                                         retain)), name)
+                                   for name, data in rows))
+            self.changed()
+
+        compacted = self.path + '.compact'
+        if os.path.exists(compacted):
+            os.remove(compacted)
+        self.conn.execute("VACUUM INTO ?", (compacted,))
+        self.conn.close()
+        os.replace(compacted, self.path)
+        self.open()
+
+    def import_bulk(self, bulk_path, retain=()):
+        """Index the cards in a Scryfall bulk data file (e.g. Oracle Cards,
+        from https://scryfall.com/docs/api/bulk-data). The file is parsed
+        incrementally and only the fields in card_fields (and retain) are
+        kept. Multi-faced cards can also be found by the name of any face.
+        Cards already in the store are replaced, since bulk data is newer
+        than anything downloaded before it. Returns the number of cards
+        indexed."""
+
+        count = 0
+
+        def rows():
+            nonlocal count
+            for data in iter_json_array(bulk_file):
+                if data.get('layout') in self.skip_layouts:
+                    continue
+                faces = [face['name'] for face in data.get('card_faces', [])]
+                text = json.dumps(parse_card(data, retain))
+                yield (data['name'], text)
+                for face in faces:
+                    yield (face, text)
+                count += 1
+
+        with open(bulk_path, 'r', encoding='utf-8') as bulk_file:
+            with self.conn:
+                self.conn.executemany("INSERT OR REPLACE INTO cards "
+                                      "VALUES (?, ?)", rows())
+                self.changed()
+
+        return count
+
+    def close(self):
+        self.conn.close()
 
 
 class Cards():
     """Simple database of card data from Scryfall."""
 
+    # Minimum interval between API requests, in seconds, across all workers
     rate_limit = .1
 
-    def __init__(self, path=None):
+    # Scryfall accepts at most this many identifiers per collection request
+    batch_size = 75
 
-        # save and load data here
-        if path:
-            self.path = path
-            if os.path.isfile(path):
-                with open(path, 'r') as db_file:
-                    self.db = json.loads(db_file.read())
-            else:
-                self.db = dict()
+    # Concurrent requests (and pooled connections)
+    workers = 4
+
+    # Retry policy for throttled or failed requests: exponential backoff
+    # starting at backoff seconds, capped at max_backoff, with jitter
+    max_retries = 5
+    backoff = .5
+    max_backoff = 30
+
+    # Seconds to wait for the API to connect or answer before retrying
+    timeout = 30
 
-        # temporary database
-        else:
-            self.db = dict()
-            self.path = None
+    def __init__(self, path=None, api_url='https://api.scryfall.com',
+                 store=None, retain=()):
+        """Card data is kept in a CardStore: the one given, or one opened at
+        path. Without either, downloaded data is only kept in memory. Fields
+        of downloaded Scryfall data named in retain are kept along with
+        card_fields."""
 
-    def add_card(self, name, api_url='https://api.scryfall.com'):
+        self.api_url = api_url
+        self.retain = tuple(retain)
+
+        # Created on first use; see request()
+        self.session = None
+        self.bucket = None
+
+        # save and load data here
+        if store is None and path:
+            store = CardStore(path)
+        self.store = store
+        self.path = store.path if store is not None else None
+
+        # Cards read or downloaded so far, by the name they were asked for
+        self.db = dict()
+
+        # Names of downloaded cards not yet written to the store
+        self.new = set()
+
+        # What it took to find card data (see tally)
+        self.stats = collections.Counter()
+        self.lock = threading.Lock()
+
+    def tally(self, key, num=1):
+        """Add to one of the statistics in self.stats: cards found in memory
+        ('memory'), in the store ('store'), 'downloaded' or 'not_found';
+        API 'requests' made and 'retries' of them; and seconds spent waiting
+        for the rate limit ('rate_limited') or backing off ('backoff')."""
+        with self.lock:
+            self.stats[key] += num
+
+    def request(self, method, url, **kwargs):
+        """Make an API request through a pooled session, at most one per
+        rate_limit seconds across all threads. Throttled (429) and server
+        error responses, and requests that fail to connect or time out
+        (see timeout), are retried with exponential backoff and jitter,
+        honouring Retry-After, up to max_retries times. Returns the final
+        response; raises CardAPIError if the API cannot be reached."""
+
+        # Only needed on a cache miss, and slow to import
+        import requests
+
+        if self.session is None:
+            self.session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=self.workers)
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+            self.bucket = TokenBucket(1 / self.rate_limit if self.rate_limit
+                                      else 0)
+
+        for attempt in range(self.max_retries + 1):
+            self.tally('rate_limited', self.bucket.take())
+            self.tally('requests')
+            try:
+                r = self.session.request(method, url, timeout=self.timeout,
+                                         **kwargs)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as e:
+                status, error, retry_after = None, e, None
+            else:
+                if r.status_code != 429 and r.status_code < 500:
+                    return r
+                status, error = r.status_code, None
+                retry_after = r.headers.get('Retry-After')
+
+            if attempt == self.max_retries:
+                break
+
+            delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+            delay = random.uniform(delay / 2, delay)
+            if retry_after is not None and retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+
+            if status == 429:
+                logging.warning("Rate limit exceeded, throttling for %.1fs",
+                                delay)
+                # Every worker backs off, not just this one
+                self.bucket.hold(delay)
+            else:
+                logging.warning("Request failed (%s), retrying in %.1fs",
+                                status or error, delay)
+            self.tally('retries')
+            self.tally('backoff', delay)
+            time.sleep(delay)
+
+        if status is None:
+            raise CardAPIError("Error communicating with API: {}".format(
+                error))
+        raise CardAPIError("Error communicating with API: status code "
+                           "{}".format(status))
+
+    def add_card(self, name, api_url=None):
         """Download card data by name from Scryfall and add it to the card
         database. For silver-bordered cards, this is not enough for unambiguous
         identification. Skips downloading cards that are already in the
-        database."""
-
-        if name not in self.db:
-            print("Fetching {}".format(name))
-            query = "{}/cards/named?exact={}".format(api_url, name)
-            time.sleep(self.rate_limit)
-            r = requests.get(query)
-            if r.status_code == 200:
-                self.db[name] = json.loads(r.text)
-                # https://scryfall.com/docs/api/layouts
-                # Split cards should be handled differently - unclear how.
-                # Currently, just ignore other card faces, but if layout
-                # is 'split', this doesn't make sense.
-
-                if 'card_faces' in self.db[name]:
-                    # Use the global cmc; other card details from front face
-                    cmc = self.db[name].get('cmc', 0)
-                    self.db[name] = self.db[name]['card_faces'][0]
-                    self.db[name]['cmc'] = cmc
-
-                # Compatibility with previous Deckbrew format
-                self.db[name]['cost'] = self.db[name]['mana_cost']
-
-                # Parse typeline
-                typeline = self.db[name]['type_line'].lower()
-
-                # Parse card type into types (including supertype) and creature type
-                # A set might make more logical sense, but for now easier
-                # to use lists with default JSON encoder.
-                # Cover unlikely event of an empty typeline
-                self.db[name]['types'] = list()
-
-                if '—' in typeline:
-                    self.db[name]['types'] = typeline.split('—', 1)[0].strip().split(' ')
-                    self.db[name]['subtypes'] = typeline.split('—', 1)[1].strip().split(' ')
-                else:
-                    self.db[name]['types'] = typeline.split(' ')
-                    self.db[name]['subtypes'] = list()
-
-                logging.debug("%s\n\tCost: %s\n\t%s\n\t%s %s", name,
-                              self.db[name]['cost'],
-                              Faction.who_can_play(self.db[name]['cost']),
-                              self.db[name]['types'],
-                              self.db[name]['subtypes'])
+        database. Raises CardAPIError if the card is not found."""
 
-                r.connection.close()
+        if api_url is None:
+            api_url = self.api_url
 
-            # Too many requests: wait, decrease rate, try again
-            elif r.status_code == 429:
-                logging.warning("Rate limit exceeded, throttling...")
-                self.rate_limit += .1
-                time.sleep(2)
-                self.add_card(name)
+        if self.get(name) is None:
+            print("Fetching {}".format(name), file=sys.stderr)
+            r = self.request('GET', "{}/cards/named".format(api_url),
+                             params={'exact': name})
+            if r.status_code == 200:
+                self.db[name] = parse_card(r.json(), self.retain)
+                self.new.add(name)
+                self.tally('downloaded')
+                self.save()
 
             # Otherwise fail
             elif r.status_code == 404:
-                r.connection.close()
-                exit("Card {} not found in API!".format(name))
+                raise CardAPIError("Card {} not found in API!".format(name))
 
             else:
-                r.connection.close()
-                exit("Error communicating with API: status code {}".
-                     format(r.status_code))
+                raise CardAPIError("Error communicating with API: status "
+                                   "code {}".format(r.status_code))
+
+    def add_cards(self, names, api_url=None):
+        """Download card data for every name not already in the card database,
+        using Scryfall's collection endpoint to fetch up to batch_size cards
+        per request, with up to workers requests in flight. Returns the list
+        of names that could not be found, in the order given. Raises
+        CardAPIError if the API fails."""
+        return self.add_batches([names], api_url)
+
+    def add_batches(self, batches, api_url=None):
+        """As add_cards, for names that arrive in batches (any iterable of
+        lists of names, e.g. a generator yielding them as a cube is read;
+        see cubealyzer.stream_cube). Each is downloaded as soon as it
+        arrives, while up to workers requests for earlier ones are still in
+        flight."""
+
+        if api_url is None:
+            api_url = self.api_url
+
+        missing = list()
+
+        def collect(batch, future):
+            result = future.result()
+            for name in batch:
+                if name in result:
+                    self.db[name] = parse_card(result[name], self.retain)
+                    self.new.add(name)
+                else:
+                    missing.append(name)
+            self.tally('downloaded', sum(name in result for name in batch))
+            self.tally('not_found', sum(name not in result for name in batch))
+
+            # Keep what has been downloaded if a later batch fails
+            self.save()
+
+        # (names, future) of the requests in flight, oldest first
+        pending = collections.deque()
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+            for names in batches:
+
+                # Preserve order, drop duplicates and anything already cached
+                names = list(dict.fromkeys(names))
+                wanted = [name for name in names if name not in self.db]
+                self.tally('memory', len(names) - len(wanted))
+
+                if self.store is not None and wanted:
+                    self.db.update(self.store.lookup(wanted))
+                    found = len(wanted)
+                    wanted = [name for name in wanted if name not in self.db]
+                    self.tally('store', found - len(wanted))
+
+                if wanted:
+                    print("Fetching {} cards".format(len(wanted)),
+                          file=sys.stderr)
+
+                for i in range(0, len(wanted), self.batch_size):
+                    if len(pending) >= self.workers:
+                        collect(*pending.popleft())
+                    batch = wanted[i:i + self.batch_size]
+                    pending.append((batch, pool.submit(
+                        self.fetch_collection, batch, api_url)))
+
+            while pending:
+                collect(*pending.popleft())
+
+        return missing
+
+    def fetch_collection(self, names, api_url):
+        """POST one batch of names to the collection endpoint and return a
+        dict of the resulting Scryfall card objects keyed by requested name.
+        Names the API does not recognize are left out."""
+
+        r = self.request('POST', "{}/cards/collection".format(api_url),
+                         json={'identifiers': [{'name': name} for name in
+                                               names]})
+        if r.status_code != 200:
+            raise CardAPIError("Error communicating with API: status code "
+                               "{}".format(r.status_code))
+
+        # The API matches names case-insensitively, and a face name is
+        # enough to find a multi-faced card, so look results up the same way.
+        by_name = dict()
+        for data in r.json().get('data', []):
+            by_name[data['name'].lower()] = data
+            for face in data.get('card_faces', []):
+                by_name.setdefault(face['name'].lower(), data)
+
+        return {name: by_name[name.lower()] for name in names if name.lower()
+                in by_name}
 
     def get(self, name, default=None):
+        if name not in self.db and self.store is not None:
+            card = self.store.get(name)
+            if card is None:
+                return default
+            self.tally('store')
+            self.db[name] = card
         return self.db.get(name, default)
 
+    def version(self):
+        """Returns the version of the card data in the store (see
+        CardStore.version), or None if there is no store."""
+        return self.store.version() if self.store is not None else None
+
     def save(self):
-        """Write the card database file."""
-        if self.path:
-            with open(self.path, 'w') as db_file:
-                db_file.write(json.dumps(self.db))
+        """Write newly downloaded cards to the card store."""
+        if self.store is not None and self.new:
+            self.store.upsert({name: self.db[name] for name in self.new})
+        self.new.clear()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""Colored mana requirements of a cube: the colored pips of the cards each
+faction can play at each cmc, and the colored sources a deck needs to cast
+them on curve."""
+
+import functools
+import math
+from collections import Counter, defaultdict
+import mtg
+
+# Color letters, in the order of the pips in a tuple of them
+letters = mtg.Faction.cb_letters.lower()
+
+
+@functools.lru_cache(maxsize=None)
+def pips(mana, color_mask=31, mono_hybrid=.5, phyrexian=.5):
+    """Returns the pips of a ManaCost for a deck of the colors in a color
+    mask (see mtg.Faction.cb), as (weights, required), each a tuple with one
+    number for each color. Weights count colored pips as 1 and half pips as
+    .5. Hybrid pips are split among the colors of the deck that can pay
+    them. Pips that can also be paid with generic mana ({2/W}) count as
+    mono_hybrid, and those that can be paid with life ({W/P}) as phyrexian.
+    Required counts the pips that can only be paid with that color."""
+
+    weights = [0] * len(letters)
+    required = [0] * len(letters)
+
+    def payable(options):
+        return [letters.index(o) for o in options if o in letters and
+                color_mask & 1 << letters.index(o)]
+
+    for color in mana.colored:
+        weights[letters.index(color)] += 1
+        required[letters.index(color)] += 1
+    for color in mana.half:
+        if color in letters:
+            weights[letters.index(color)] += .5
+
+    for options in mana.hybrid:
+        colors = payable(options)
+        if any(option.isdigit() for option in options):
+            for i in colors:
+                weights[i] += mono_hybrid
+            continue
+        for i in colors:
+            weights[i] += 1 / len(colors)
+        if len(colors) == 1:
+            required[colors[0]] += 1
+
+    for options in mana.phyrexian:
+        colors = payable(options)
+        for i in colors:
+            weights[i] += phyrexian / len(colors)
+
+    return tuple(weights), tuple(required)
+
+
+def sources_needed(num, turn, deck_size=40, lands=17, probability=.9):
+    """Returns the fewest sources of a color, among the lands of a deck,
+    that give at least the given probability of having drawn num of them by
+    the given turn on the play (having drawn 6 + turn cards, without
+    mulligans), by the hypergeometric distribution. None if all the lands
+    would not do."""
+
+    draws = min(deck_size, 6 + max(1, turn))
+    for sources in range(num, lands + 1):
+        p = sum(math.comb(sources, k) * math.comb(deck_size - sources,
+                                                  draws - k) for k in
+                range(num, min(sources, draws) + 1)) / math.comb(deck_size,
+                                                                 draws)
+        if p >= probability:
+            return sources
+    return None
+
+
+def no_pips():
+    """Weights of no pips of any color (see Pips.weights)."""
+    return [0] * len(letters)
+
+
+class Pips():
+    """Colored pips of cards by faction, card type and cmc, collected card
+    by card in the same pass over a cube as cubealyzer.Counts. Type None
+    stands for any nonland permanent and any_type for any card; faction None
+    for any faction, whose pips are counted as if every color were
+    available."""
+
+    any_type = mtg.any_type
+    permanent_types = mtg.permanent_types
+
+    # See pips
+    mono_hybrid = .5
+    phyrexian = .5
+
+    def __init__(self):
+
+        # (faction, type, cmc) : [ weight of each color ]
+        self.weights = defaultdict(no_pips)
+
+        # (faction, type, color letter) : Counter({ (cmc, pips) : num })
+        self.required = defaultdict(Counter)
+
+    def add(self, card, num=1):
+        """Count the pips of num copies of a card (or a face of one, see
+        mtg.card_faces), or remove them if num is negative."""
+
+        mana = mtg.card_mana(card)
+        cmc = card.get('cmc', 0)
+
+        types = [self.any_type] + list(dict.fromkeys(card.get('types')))
+        if self.permanent_types.intersection(card.get('types')):
+            types.append(None)
+
+        factions = list(mtg.Faction.names(mtg.Faction.playable_mask(mana)))
+        for faction in factions + [None]:
+            weights, required = pips(mana, mtg.Faction.cm.get(faction, 31),
+                                     self.mono_hybrid, self.phyrexian)
+            if not any(weights):
+                continue
+            for card_type in types:
+                row = self.weights[(faction, card_type, cmc)]
+                for i, weight in enumerate(weights):
+                    row[i] += weight * num
+                for i, n in enumerate(required):
+                    if n:
+                        self.required[(faction, card_type, letters[i])][
+                            (cmc, n)] += num
+
+    def curve(self, faction, card_type='creature'):
+        """Returns the pips of the cards of a type playable by a faction as
+        { cmc : { color letter : weight } }, leaving out zeros."""
+
+        curve = dict()
+        for (f, t, cmc), row in self.weights.items():
+            if f != faction or t != card_type:
+                continue
+            colors = {letters[i]: w for i, w in enumerate(row) if
+                      abs(w) > 1e-9}
+            if colors:
+                curve[cmc] = colors
+
+        return curve
+
+    def requirements(self, faction, card_type='creature'):
+        """Returns the most pips of each color that any card of a type
+        playable by a faction requires at each cmc, as { color letter :
+        { cmc : pips } }."""
+
+        result = dict()
+        for color in letters:
+            by_cmc = dict()
+            for (cmc, n), num in self.required.get((faction, card_type,
+                                                    color), {}).items():
+                if num > 0:
+                    by_cmc[cmc] = max(by_cmc.get(cmc, 0), n)
+            if by_cmc:
+                result[color] = by_cmc
+
+        return result
+
+    def sources(self, faction, card_type='creature', deck_size=40, lands=17,
+                probability=.9):
+        """Returns the colored sources a deck of a faction needs to cast
+        every card of a type it can play on curve with the given probability
+        (see sources_needed), as { color letter : sources }. None if even
+        all its lands would not do."""
+
+        result = dict()
+        for color, by_cmc in self.requirements(faction, card_type).items():
+            needed = [sources_needed(n, int(cmc), deck_size, lands,
+                                     probability) for cmc, n in
+                      by_cmc.items()]
+            result[color] = None if None in needed else max(needed)
+
+        return result
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""Filter expressions over the cards of a cube, such as
+
+    type:creature sub:elf cmc<=3 faction:golgari
+
+An expression is a list of terms, all of which a card must match. A term is
+a key, an operator and a value: type (or t), subtype (sub, s) and faction
+(f) take ':'; cmc (mv) takes ':', '=', '!=', '<', '<=', '>' or '>='; name
+matches any card whose name contains the value. A term preceded by '-'
+matches the cards the term alone would not. Values with spaces are quoted.
+
+Expressions are compiled once into a Query, which finds the matching cards
+by intersecting sets of names from an index of the cube (see
+cubealyzer.Index) rather than by checking every card."""
+
+import functools
+import operator
+import re
+import shlex
+from collections import namedtuple
+import mtg
+
+Term = namedtuple('Term', ['key', 'op', 'value', 'negated'])
+
+keys = {'type': 'type', 't': 'type', 'subtype': 'subtype', 'sub': 'subtype',
+        's': 'subtype', 'faction': 'faction', 'f': 'faction', 'cmc': 'cmc',
+        'mv': 'cmc', 'name': 'name'}
+
+ops = {':': operator.eq, '=': operator.eq, '!=': operator.ne,
+       '<': operator.lt, '<=': operator.le, '>': operator.gt,
+       '>=': operator.ge}
+
+term_pattern = re.compile(r'(-?)([a-z]+)(<=|>=|!=|:|=|<|>)(.+)$')
+
+
+def parse(expression):
+    """Returns the terms of an expression as a tuple of Terms. Raises
+    ValueError if it is not a valid expression."""
+
+    terms = list()
+
+    for token in shlex.split(expression):
+        match = term_pattern.match(token.lower())
+        if match is None:
+            raise ValueError("Not a query term: {}".format(token))
+        negated, key, op, value = match.groups()
+
+        if key not in keys:
+            raise ValueError("Unknown query key: {}".format(key))
+        key = keys[key]
+
+        if key == 'cmc':
+            try:
+                value = float(value)
+            except ValueError:
+                raise ValueError("Not a cmc: {}".format(value))
+        elif op != ':':
+            raise ValueError("{} only takes ':'".format(key))
+        elif key == 'faction' and value not in mtg.Faction.all_factions:
+            raise ValueError("Unknown faction: {}".format(value))
+
+        terms.append(Term(key, op, value, bool(negated)))
+
+    return tuple(terms)
+
+
+class Query():
+    """A compiled filter expression."""
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.terms = parse(expression)
+
+    def match(self, index):
+        """Returns the set of names of the cards in an index that match."""
+
+        names = set(index.names)
+
+        for term in self.terms:
+            if term.negated:
+                names.difference_update(self.select(index, term))
+            else:
+                names.intersection_update(self.select(index, term))
+
+        return names
+
+    def select(self, index, term):
+        """Returns the names of the cards in an index that match a term
+        (ignoring negation)."""
+
+        if term.key == 'type':
+            return index.types.get(term.value, ())
+        if term.key == 'subtype':
+            return index.subtypes.get(term.value, ())
+        if term.key == 'faction':
+            return index.playable(term.value)
+        if term.key == 'cmc':
+            op = ops[term.op]
+            return set().union(*(names for cmc, names in index.cmcs.items()
+                                 if op(cmc, term.value)))
+        return {name for name in index.names if term.value in name.lower()}
+
+
+@functools.lru_cache(maxsize=256)
+def compile(expression):
+    """Returns a Query for an expression, compiled once however often it is
+    asked for."""
+    return Query(expression)
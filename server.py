@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""Local HTTP server that analyzes cube lists posted to it. Card data, and
+the results of recent analyses, stay in memory between requests.
+
+POST /analyze with a cube list (a cubetutor CSV export) as the body returns
+JSON of its counts by faction type (see cubealyzer.summarize). The query may
+give faction types (e.g. factions=cg, default c), type (default creature),
+subtype, and a filter expression (see query.py) whose matching cards and
+curve are returned too. Cards unknown to the API are answered with status
+422 and the list of them, and failures of the API with status 502. GET
+/status returns the numbers of cards and results held."""
+
+import hashlib
+import json
+import logging
+import urllib.parse
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import cubealyzer
+import mtg
+from query import compile as compile_query
+
+
+class Analyzer():
+    """Analyses of cubes using one set of card data (an mtg.Cards), of which
+    the last max_results are kept by a hash of the cube contents and the
+    analysis asked for."""
+
+    max_results = 128
+
+    def __init__(self, cards):
+        self.cards = cards
+        self.results = OrderedDict()
+
+    def key(self, contents, faction_types, card_type, sub_type, expression):
+        """Hash of a cube's contents and an analysis of it."""
+        data = json.dumps([sorted(contents.items()), faction_types, card_type,
+                           sub_type, expression])
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def analyze(self, contents, faction_types='c', card_type='creature',
+                sub_type=None, expression=None):
+        """Returns the counts of a cube with the given contents ({ name :
+        count }), as { 'cube' : hash, 'summary' : counts }, with 'query' :
+        { 'cards' : { name : count }, 'curve' : curve } if given a filter
+        expression, or { 'missing' : names } if any of its cards are unknown
+        to the API."""
+
+        key = self.key(contents, faction_types, card_type, sub_type,
+                       expression)
+        if key in self.results:
+            self.results.move_to_end(key)
+            return self.results[key]
+
+        missing = self.cards.add_cards(contents)
+        self.cards.save()
+        if missing:
+            return {'missing': missing}
+
+        cube = cubealyzer.Cube(key, None, contents=contents, cards=self.cards)
+        result = {'cube': key, 'summary': cubealyzer.summarize(
+            cube, faction_types, card_type, sub_type)}
+        if expression is not None:
+            result['query'] = {'cards': cube.query(expression),
+                               'curve': cube.query_curve(expression)}
+
+        self.results[key] = result
+        if len(self.results) > self.max_results:
+            self.results.popitem(last=False)
+
+        return result
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Requests to a server made by make_server."""
+
+    def log_message(self, format, *args):
+        logging.info("%s - %s", self.address_string(), format % args)
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        analyzer = self.server.analyzer
+        if urllib.parse.urlparse(self.path).path != '/status':
+            return self.reply(404, {'error': 'not found'})
+        self.reply(200, {'cards': len(analyzer.cards.db),
+                         'results': len(analyzer.results)})
+
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path != '/analyze':
+            return self.reply(404, {'error': 'not found'})
+
+        query = urllib.parse.parse_qs(url.query)
+        faction_types = query.get('factions', ['c'])[0]
+        if not set(faction_types) <= set(mtg.Faction.fsh):
+            return self.reply(400, {'error': 'unknown faction type'})
+
+        expression = query.get('query', [None])[0]
+        if expression is not None:
+            try:
+                compile_query(expression)
+            except ValueError as e:
+                return self.reply(400, {'error': str(e)})
+
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length).decode('utf-8')
+        contents = cubealyzer.parse_cube(body.splitlines())
+
+        try:
+            result = self.server.analyzer.analyze(
+                contents, list(faction_types),
+                query.get('type', ['creature'])[0],
+                query.get('subtype', [None])[0], expression)
+        except mtg.CardAPIError as e:
+            return self.reply(502, {'error': str(e)})
+        self.reply(422 if 'missing' in result else 200, result)
+
+
+def make_server(cards, host='127.0.0.1', port=8080):
+    """Returns an HTTPServer analyzing cubes with the given mtg.Cards. It
+    handles one request at a time, so card data is only read and written by
+    the thread serving it."""
+
+    server = HTTPServer((host, port), Handler)
+    server.analyzer = Analyzer(cards)
+    return server
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""Monte Carlo simulation of the packs opened from a cube. Requires NumPy."""
+
+from collections import namedtuple
+import numpy as np
+import mtg
+
+# Mean and percentiles of a number of cards over simulated drafts
+Stats = namedtuple('Stats', ['mean', 'percentiles'])
+
+
+class Simulation():
+    """The cards of a type and subtype (see columns.Columns.select) that each
+    faction of a type could play, at each cmc, among the packs of pack_size
+    cards opened in simulated drafts of a cube. Cards with several faces that
+    can be cast count once for each face at its cmc, but only once in the
+    total over all cmcs, as in cubealyzer.Counts. A draft
+    opens a number of packs, drawn from the cube without replacement. Drafts
+    are simulated in chunks of chunk_size at once, each with its own random
+    generator, so the results for a seed are the same however many processes
+    run them."""
+
+    chunk_size = 10000
+
+    def __init__(self, cube, faction_type='g', card_type='creature',
+                 sub_type=None, packs=1, pack_size=15):
+
+        cols = cube.columns()
+
+        # One entry per copy of a card
+        entries = np.repeat(np.arange(len(cols.card_names)), cols.card_copies)
+
+        self.draws = packs * pack_size
+        if self.draws > len(entries):
+            raise ValueError("{} packs of {} need {} cards, the cube has "
+                             "{}".format(packs, pack_size, self.draws,
+                                         len(entries)))
+
+        self.entries = len(entries)
+        self.factions = mtg.Faction.get_factions(faction_type)
+        self.cmcs = cols.cmcs.tolist()
+
+        # What each card counts for: faces x factions, summed by card and cmc
+        bits = np.array([mtg.Faction.bit[f] for f in self.factions],
+                        dtype=np.int64)
+        playable = ((cols.castable[:, None] & bits) != 0) & cols.select(
+            None, card_type, sub_type)[:, None]
+        by_card = np.zeros((len(cols.card_names), len(self.factions),
+                            len(self.cmcs)), dtype=np.int64)
+        np.add.at(by_card, (cols.card[:, None],
+                            np.arange(len(self.factions)),
+                            cols.cmc_index[:, None]),
+                  playable.astype(np.int64))
+
+        # Then whether each card counts at all, for the total over all cmcs
+        by_card = np.concatenate([by_card, by_card.any(axis=2, keepdims=True)],
+                                 axis=2)
+
+        # Cards fall into few classes that count for the same; drafts are
+        # counted by class and then by faction. classes x factions x cmcs
+        # and then the total
+        classes, class_index = np.unique(by_card.reshape(len(by_card), -1),
+                                         axis=0, return_inverse=True)
+        self.class_index = class_index.ravel()[entries]
+        self.weights = classes.reshape(len(classes), len(self.factions),
+                                       len(self.cmcs) + 1)
+
+        # The most cards one faction can count at one cmc in a draft
+        self.most = self.draws * max(1, int(by_card.max(initial=0)))
+
+    def histograms(self, drafts, seed):
+        """Returns how many of drafts (simulated with the given
+        numpy.random.SeedSequence) had each number of playable cards, as an
+        array of factions x cmcs and then the total over all cmcs x number of
+        cards."""
+
+        rng = np.random.default_rng(seed)
+        factions = len(self.factions)
+        cmcs = len(self.cmcs)
+
+        # The cards drawn are the first of a random ordering of the cube
+        keys = rng.random((drafts, self.entries), dtype=np.float32)
+        drawn = np.argpartition(keys, self.draws - 1, axis=1)[:, :self.draws]
+
+        # Cards drawn by draft and class, then faction and cmc
+        classes = len(self.weights)
+        cells = np.arange(drafts)[:, None] * classes + self.class_index[drawn]
+        counts = np.bincount(cells.ravel(), minlength=drafts *
+                             classes).reshape(drafts, classes)
+        counts = np.tensordot(counts, self.weights, axes=1).transpose(1, 0, 2)
+
+        # Then drafts by faction, cmc and count
+        cells = (np.arange(factions).reshape(factions, 1, 1) * (cmcs + 1) +
+                 np.arange(cmcs + 1)) * (self.most + 1) + counts
+        return np.bincount(cells.ravel(), minlength=factions * (cmcs + 1) *
+                           (self.most + 1)).reshape(factions, cmcs + 1,
+                                                     self.most + 1)
+
+    def run(self, drafts, seed=None, processes=1):
+        """Simulates a number of drafts, in a pool of processes if more than
+        one. Returns histograms as histograms does."""
+
+        chunks = [self.chunk_size] * (drafts // self.chunk_size)
+        if drafts % self.chunk_size:
+            chunks.append(drafts % self.chunk_size)
+        seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+
+        if processes == 1 or len(chunks) == 1:
+            results = map(self.histograms, chunks, seeds)
+            return sum(results, np.zeros((len(self.factions),
+                                          len(self.cmcs) + 1,
+                                          self.most + 1), dtype=np.int64))
+
+        import multiprocessing
+        with multiprocessing.Pool(processes) as pool:
+            return sum(pool.starmap(self.histograms, zip(chunks, seeds)))
+
+    def summary(self, hist, percentiles=(5, 50, 95)):
+        """Returns { faction : { cmc : Stats } } from histograms, where cmc
+        None is for cards of any cmc. Percentiles are of the nearest rank."""
+
+        values = np.arange(self.most + 1)
+        cmcs = self.cmcs + [None]
+        summary = dict()
+
+        for faction, by_cmc in zip(self.factions, hist):
+            summary[faction] = dict()
+            for cmc, counts in zip(cmcs, by_cmc):
+                total = counts.sum()
+                cumulative = np.cumsum(counts)
+                summary[faction][cmc] = Stats(
+                    float(values @ counts / total),
+                    tuple(int(np.searchsorted(cumulative, total * p / 100))
+                          for p in percentiles))
+
+        return summary
+
+    def simulate(self, drafts, seed=None, processes=1,
+                 percentiles=(5, 50, 95)):
+        """Simulates a number of drafts and returns their summary."""
+        return self.summary(self.run(drafts, seed, processes), percentiles)
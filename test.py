@@ -1,9 +1,139 @@
 #!/usr/bin/env python3
 """Unit tests for cubealyzer."""
 
+import contextlib
+import csv
+import importlib.util
+import io
+import json
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import mtg
+import cache
 import cubealyzer
+import export
+import pips
+import query
+import server
+
+
+def scryfall_card(name, mana_cost, type_line, cmc, **extra):
+    """A minimal Scryfall card object."""
+    card = {'object': 'card', 'name': name, 'mana_cost': mana_cost,
+            'type_line': type_line, 'cmc': cmc}
+    card.update(extra)
+    return card
+
+
+STUB_CARDS = [
+    scryfall_card("Pack Rat", "{1}{B}", "Creature — Rat", 2.0),
+    scryfall_card("Isamaru, Hound of Konda", "{W}", "Legendary Creature — Dog",
+                  1.0),
+    scryfall_card("Gitaxian Probe", "{U/P}", "Sorcery", 1.0),
+    scryfall_card("Dryad Arbor", "", "Land Creature — Forest Dryad", 0.0),
+    scryfall_card("Far // Away", "{1}{U} // {2}{B}", "Instant // Instant",
+                  5.0, layout='split', card_faces=[
+                      {'name': 'Far', 'mana_cost': '{1}{U}',
+                       'type_line': 'Instant'},
+                      {'name': 'Away', 'mana_cost': '{2}{B}',
+                       'type_line': 'Instant'}]),
+] + [scryfall_card("Filler {}".format(i), "{{{}}}".format(i % 7),
+                   "Artifact Creature — Construct", float(i % 7))
+     for i in range(80)]
+
+
+class StubScryfall():
+    """Serves STUB_CARDS from the Scryfall endpoints cubealyzer uses, on a
+    local port. Requests are recorded as (method, path) in self.requests."""
+
+    def __init__(self, cards=STUB_CARDS):
+        self.cards = {card['name'].lower(): card for card in cards}
+        self.requests = list()
+        # (status, headers) to answer with before serving normally
+        self.failures = list()
+        # Number of requests to leave unanswered for stall seconds
+        self.stalls = 0
+        self.stall = 1
+        # Seconds to take over each batch, and the most batches in flight
+        self.delay = 0
+        self.in_flight = 0
+        self.most_in_flight = 0
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                pass
+
+            def reply(self, status, headers=(), body={}):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for header in headers:
+                    self.send_header(*header)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                stub.requests.append(('GET', self.path))
+                if stub.failures:
+                    return self.reply(*stub.failures.pop(0))
+                url = urllib.parse.urlparse(self.path)
+                name = urllib.parse.parse_qs(url.query)['exact'][0]
+                if name.lower() in stub.cards:
+                    self.reply(200, body=stub.cards[name.lower()])
+                else:
+                    self.reply(404, body={'object': 'error'})
+
+            def do_POST(self):
+                stub.requests.append(('POST', self.path))
+                length = int(self.headers['Content-Length'])
+                body = json.loads(self.rfile.read(length))
+                if stub.stalls:
+                    stub.stalls -= 1
+                    time.sleep(stub.stall)
+                    return
+                if stub.failures:
+                    return self.reply(*stub.failures.pop(0))
+                with stub.lock:
+                    stub.in_flight += 1
+                    stub.most_in_flight = max(stub.most_in_flight,
+                                              stub.in_flight)
+                time.sleep(stub.delay)
+                with stub.lock:
+                    stub.in_flight -= 1
+                data, not_found = list(), list()
+                for identifier in body['identifiers']:
+                    card = stub.cards.get(identifier['name'].lower())
+                    if card is None:
+                        not_found.append(identifier)
+                    else:
+                        data.append(card)
+                self.reply(200, body={'object': 'list',
+                                      'not_found': not_found, 'data': data})
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       args=(.05,), daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
 
 
 class Tests(unittest.TestCase):
@@ -14,11 +144,11 @@ class Tests(unittest.TestCase):
                          "Liliana, Heretical Healer")
 
     testcube_input_csv = 'testcube.csv'
-    testcube_output_json = 'testcube.json'
+    testcube_db = 'testcube.db'
 
     def setUp(self):
         self.testcube = cubealyzer.Cube(self.testcube_input_csv,
-                                        self.testcube_output_json)
+                                        self.testcube_db)
 
     def tearDown(self):
         self.testcube.cards.save()
@@ -123,5 +253,1149 @@ class Tests(unittest.TestCase):
         self.assertEqual(mtg.Faction.who_can_play('{{1}}{{P/C}}'), mtg.Faction.all_factions)
 
 
+class FactionTests(unittest.TestCase):
+    """Faction masks."""
+
+    def test_playable_by(self):
+        """The 32-entry table agrees with the faction color lists."""
+        esper = mtg.Faction.cb['white'] | mtg.Faction.cb['blue']
+        self.assertEqual(mtg.Faction.names(mtg.Faction.playable_by[esper]),
+                         mtg.Faction.who_can_play('azorius'))
+        self.assertEqual(mtg.Faction.playable_by[0], mtg.Faction.everyone)
+        self.assertEqual(mtg.Faction.names(mtg.Faction.playable_by[31]),
+                         set())
+
+    def test_masks(self):
+        """Costs map to faction masks and immutable sets of names."""
+        mask = mtg.Faction.playable_mask('{1}{B}{G}')
+        self.assertEqual(mtg.Faction.names(mask),
+                         mtg.Faction.who_can_play('golgari'))
+        self.assertIsInstance(mtg.Faction.who_can_play('{R}'), frozenset)
+        self.assertTrue(mtg.Faction.can_play('temur', '{G/U}{R}'))
+        self.assertFalse(mtg.Faction.can_play('boros', '{G/U}{R}'))
+
+
+class ManaCostTests(unittest.TestCase):
+    """Mana costs parsed into their symbols."""
+
+    def test_parse(self):
+        """Each kind of symbol is counted separately."""
+        cost = mtg.ManaCost.parse('{2}{W}{W}{U/B}{2/R}{G/P}{HW}{X}{C}')
+        self.assertEqual(cost.generic, 2)
+        self.assertEqual(cost.x, 1)
+        self.assertEqual(cost.colorless, 1)
+        self.assertEqual(cost.colored, ('w', 'w'))
+        self.assertEqual(cost.hybrid, (('u', 'b'), ('2', 'r')))
+        self.assertEqual(cost.phyrexian, (('g',),))
+        self.assertEqual(cost.half, ('w',))
+
+    def test_playable(self):
+        """Playability is computed from the parsed form."""
+        self.assertEqual(mtg.Faction.playable_mask(mtg.ManaCost.parse('{HW}')),
+                         mtg.Faction.membership['white'])
+        self.assertEqual(mtg.Faction.who_can_play('{2/R}{G/P}'),
+                         mtg.Faction.all_factions)
+        self.assertEqual(mtg.Faction.who_can_play(''),
+                         mtg.Faction.all_factions)
+
+    def test_colorless_phyrexian(self):
+        """A phyrexian symbol of no color ({P}) can be paid by anyone."""
+        cost = mtg.ManaCost.parse('{1}{P}')
+        self.assertEqual(cost.phyrexian, ((),))
+        self.assertEqual(cost.other, ())
+        self.assertEqual(mtg.Faction.who_can_play(cost),
+                         mtg.Faction.all_factions)
+        self.assertEqual(mtg.Faction.who_can_play('{P}{B}'),
+                         mtg.Faction.who_can_play('{B}'))
+        self.assertEqual(mtg.mana_value(cost), 2)
+        self.assertEqual(mtg.ManaCost.load([1, 0, 0, [], [], [], [], ['P']]),
+                         cost)
+
+    def test_stored(self):
+        """The parsed cost is kept with the card and survives the store."""
+        card = mtg.parse_card(STUB_CARDS[0])
+        self.assertEqual(card['mana'], mtg.ManaCost.parse('{1}{B}'))
+        store = mtg.CardStore(':memory:')
+        store.upsert({"Pack Rat": card})
+        self.assertEqual(store.get("Pack Rat"), card)
+        self.assertEqual(mtg.card_mana({'cost': '{G}'}),
+                         mtg.ManaCost.parse('{G}'))
+
+
+class CollectionTests(unittest.TestCase):
+    """Fetch card data in batches from a local stand-in for Scryfall."""
+
+    def setUp(self):
+        self.api = StubScryfall()
+        self.cards = mtg.Cards(api_url=self.api.url)
+        self.cards.rate_limit = 0
+        self.cards.backoff = 0
+
+    def tearDown(self):
+        self.api.close()
+
+    def test_batches(self):
+        """Names are fetched at most batch_size to a request."""
+        names = ["Filler {}".format(i) for i in range(80)]
+        self.assertEqual(self.cards.add_cards(names), [])
+        self.assertEqual(self.api.requests,
+                         [('POST', '/cards/collection')] * 2)
+        self.assertEqual(self.cards.get("Filler 9").get('types'),
+                         ['artifact', 'creature'])
+
+    def test_cached(self):
+        """Cached names are not requested again."""
+        self.cards.add_cards(["Pack Rat"])
+        self.cards.add_cards(["Pack Rat", "Pack Rat"])
+        self.assertEqual(len(self.api.requests), 1)
+
+    def test_missing(self):
+        """Every unknown name is reported, not just the first."""
+        missing = self.cards.add_cards(["Pack Rat", "No Such Card",
+                                        "Gitaxian Probe", "Nor This"])
+        self.assertEqual(missing, ["No Such Card", "Nor This"])
+        self.assertIsNotNone(self.cards.get("Gitaxian Probe"))
+
+    def test_card_faces(self):
+        """Multi-faced cards keep the front face and the global cmc."""
+        self.cards.add_cards(["Far // Away"])
+        card = self.cards.get("Far // Away")
+        self.assertEqual(card['cost'], '{1}{U}')
+        self.assertEqual(card['cmc'], 5.0)
+        self.assertEqual([(f['name'], f['cost'], f['cmc']) for f in
+                          mtg.card_faces(card)],
+                         [('Far', '{1}{U}', 2.0), ('Away', '{2}{B}', 3.0)])
+
+    def test_layouts(self):
+        """Every face of modal double-faced and adventure cards can be cast,
+        only the front of transforming ones."""
+        faces = [{'name': 'Front', 'mana_cost': '{1}{G}',
+                  'type_line': 'Creature — Elf'},
+                 {'name': 'Back', 'mana_cost': '', 'type_line': 'Land'}]
+        for layout, names in (('modal_dfc', ['Front', 'Back']),
+                              ('adventure', ['Front', 'Back']),
+                              ('transform', ['Front'])):
+            card = mtg.parse_card(scryfall_card(
+                "Front // Back", "", "Creature — Elf // Land", 2.0,
+                layout=layout, card_faces=faces))
+            self.assertEqual([f['name'] for f in mtg.card_faces(card)], names)
+            self.assertEqual(mtg.card_faces(card)[0]['cmc'], 2.0)
+            self.assertEqual(mtg.card_faces(card)[-1]['types'],
+                             ['land'] if len(names) > 1 else ['creature'])
+        self.assertEqual(mtg.mana_value(mtg.ManaCost.parse('{X}{2/W}{U/P}')),
+                         3)
+
+    def test_throttled(self):
+        """Batches rejected with status 429 are retried."""
+        self.api.failures.append((429, ()))
+        self.assertEqual(self.cards.add_cards(["Pack Rat"]), [])
+        self.assertEqual(len(self.api.requests), 2)
+
+    def test_stats(self):
+        """Requests, retries and where card data came from are counted."""
+        self.api.failures.append((429, ()))
+        self.cards.add_cards(["Pack Rat", "No Such Card"])
+        self.cards.add_cards(["Pack Rat"])
+        stats = self.cards.stats
+        self.assertEqual((stats['requests'], stats['retries']), (2, 1))
+        self.assertEqual((stats['downloaded'], stats['not_found'],
+                          stats['memory'], stats['store']), (1, 1, 1, 0))
+
+    def test_timeout(self):
+        """Requests left unanswered time out and are retried."""
+        self.cards.timeout = .2
+        self.api.stalls = 1
+        self.assertEqual(self.cards.add_cards(["Pack Rat"]), [])
+        self.assertEqual((self.cards.stats['requests'],
+                          self.cards.stats['retries']), (2, 1))
+
+    def test_retry_after(self):
+        """Retry-After is honoured when it asks for a longer wait."""
+        self.api.failures.append((429, [('Retry-After', '1')]))
+        start = time.monotonic()
+        self.cards.add_cards(["Pack Rat"])
+        self.assertGreaterEqual(time.monotonic() - start, 1)
+
+    def test_retry_limit(self):
+        """Persistent server errors give up after max_retries retries."""
+        self.api.failures.extend([(503, ())] * 10)
+        with self.assertRaises(mtg.CardAPIError):
+            self.cards.add_cards(["Pack Rat"])
+        self.assertEqual(len(self.api.requests), self.cards.max_retries + 1)
+
+    def test_single(self):
+        """Single cards are fetched by exact name through the same session."""
+        self.cards.add_card("Pack Rat")
+        self.cards.add_card("Isamaru, Hound of Konda")
+        self.assertEqual(self.cards.get("Pack Rat").get('subtypes'), ['rat'])
+        with self.assertRaises(mtg.CardAPIError):
+            self.cards.add_card("No Such Card")
+
+    def test_stream(self):
+        """Card data is requested while the cube is still being read."""
+
+        def lines():
+            yield '"Pack Rat"\n'
+            deadline = time.monotonic() + 5
+            while not self.api.requests and time.monotonic() < deadline:
+                time.sleep(.01)
+            self.assertTrue(self.api.requests)
+            yield '"Pack Rat"\n'
+            for i in range(80):
+                yield '"Filler {}"\n'.format(i)
+
+        contents, missing = cubealyzer.stream_cube(lines(), self.cards,
+                                                   queue_size=4)
+        self.assertEqual(contents["Pack Rat"], 2)
+        self.assertEqual(len(contents), 81)
+        self.assertEqual(missing, [])
+
+        cube = cubealyzer.Cube(iter(['"Isamaru, Hound of Konda"\n']), None,
+                               cards=self.cards)
+        self.assertEqual(cube.csv_file, 'stream')
+        self.assertEqual(cube.card_count('white'), 1)
+
+    def test_stream_workers(self):
+        """Batches of a streamed cube are downloaded by every worker at
+        once."""
+        self.api.delay = .2
+        lines = ['"Filler {}"\n'.format(i) for i in range(80)] + \
+            ['"Unknown {}"\n'.format(i) for i in range(520)]
+        contents, missing = cubealyzer.stream_cube(lines, self.cards)
+        self.assertEqual(len(missing), 520)
+        self.assertEqual(self.api.most_in_flight, self.cards.workers)
+        self.assertEqual(self.cards.stats['downloaded'], 80)
+
+    def test_stream_failure(self):
+        """A failed download ends reading instead of blocking it."""
+        self.cards.max_retries = 0
+        self.api.failures.append((503, ()))
+        lines = ['"Filler {}"\n'.format(i) for i in range(50)]
+        with self.assertRaises(mtg.CardAPIError):
+            cubealyzer.stream_cube(lines, self.cards, queue_size=2)
+
+    def test_cube_missing(self):
+        """A cube with unknown cards raises an error naming all of them."""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'cube.csv')
+            with open(path, 'w') as cube_file:
+                cube_file.write('"Pack Rat"\nUnknown One\nUnknown Two\n')
+            with self.assertRaises(mtg.CardsNotFoundError) as cm:
+                cubealyzer.Cube(path, None, api_url=self.api.url)
+            self.assertEqual(cm.exception.names, ["Unknown One",
+                                                  "Unknown Two"])
+            self.assertEqual(pickle.loads(pickle.dumps(cm.exception)).names,
+                             cm.exception.names)
+
+
+class CardStoreTests(unittest.TestCase):
+    """Offline card data built from a Scryfall bulk data file."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.bulk = os.path.join(self.tmp.name, 'oracle-cards.json')
+        token = scryfall_card("Rat", "", "Token Creature — Rat", 0.0,
+                              layout='token')
+        with open(self.bulk, 'w') as bulk_file:
+            # One card per line, as in Scryfall's files
+            bulk_file.write('[\n')
+            bulk_file.write(',\n'.join(json.dumps(card) for card in
+                                       STUB_CARDS + [token]))
+            bulk_file.write('\n]\n')
+        self.store = mtg.CardStore(os.path.join(self.tmp.name, 'cards.db'))
+
+    def tearDown(self):
+        self.store.close()
+        self.tmp.cleanup()
+
+    def test_import(self):
+        """Every card but the token is indexed, with only the kept fields."""
+        self.assertEqual(self.store.import_bulk(self.bulk), len(STUB_CARDS))
+        card = self.store.get("pack rat")
+        self.assertEqual(set(card), set(mtg.card_fields) - {'faces'})
+        self.assertEqual(card['subtypes'], ['rat'])
+        self.assertIsNone(self.store.get("Rat"))
+
+    def test_streaming(self):
+        """Elements are parsed correctly across chunk boundaries."""
+        with open(self.bulk) as bulk_file:
+            cards = list(mtg.iter_json_array(bulk_file, chunk_size=7))
+        self.assertEqual(len(cards), len(STUB_CARDS) + 1)
+        self.assertEqual(cards[0], STUB_CARDS[0])
+        for chunk_size in (1, 2, 3):
+            self.assertEqual(list(mtg.iter_json_array(
+                io.StringIO('[12, 345, -6.5e1, "a", true]'), chunk_size)),
+                [12, 345, -65.0, 'a', True])
+            self.assertEqual(list(mtg.iter_json_array(
+                io.StringIO(' [[1, 2], [3], []]'), chunk_size)),
+                [[1, 2], [3], []])
+
+    def test_reimport(self):
+        """Importing bulk data again replaces the cards in the store."""
+        self.store.upsert({"Pack Rat": dict(mtg.parse_card(STUB_CARDS[0]),
+                                            cmc=9.0)})
+        version = self.store.version()
+        self.store.import_bulk(self.bulk)
+        self.assertEqual(self.store.get("Pack Rat")['cmc'], 2.0)
+        self.assertNotEqual(self.store.version(), version)
+
+    def test_faces(self):
+        """Multi-faced cards can be found by full or face name."""
+        self.store.import_bulk(self.bulk)
+        self.assertEqual(self.store.get("Far // Away"), self.store.get("Away"))
+        self.assertEqual(self.store.get("Far")['cost'], '{1}{U}')
+
+    def test_migrate(self):
+        """Multi-faced cards saved without their faces by older versions are
+        dropped, to be downloaded again, and the rest kept."""
+        self.store.import_bulk(self.bulk)
+        stale = {k: v for k, v in self.store.get("Far // Away").items() if
+                 k != 'faces'}
+        self.store.upsert({name: stale for name in ("Far // Away", "Far",
+                                                    "Away")})
+        with self.store.conn:
+            self.store.conn.execute("DELETE FROM meta WHERE key = 'schema'")
+        version = self.store.version()
+        self.store.close()
+
+        self.store.open()
+        self.assertIsNone(self.store.get("Far // Away"))
+        self.assertIsNone(self.store.get("Away"))
+        self.assertEqual(len(self.store), len(STUB_CARDS) - 1)
+        self.assertNotEqual(self.store.version(), version)
+
+        # Only once
+        version = self.store.version()
+        self.store.close()
+        self.store.open()
+        self.assertEqual(self.store.version(), version)
+
+    def test_migrate_face(self):
+        """Multi-faced cards saved by older versions under a face name alone
+        are parsed again if their full data was kept, and otherwise keep
+        their front face (see CardStore.migrate)."""
+        faces = [{'name': 'Front', 'mana_cost': '{1}{G}',
+                  'type_line': 'Creature — Elf'},
+                 {'name': 'Back', 'mana_cost': '', 'type_line': 'Land'}]
+        data = scryfall_card("Front // Back", "", "Creature — Elf // Land",
+                             2.0, layout='modal_dfc', card_faces=faces)
+        stale = {k: v for k, v in mtg.parse_card(data).items() if
+                 k != 'faces'}
+        self.store.upsert({"Front": dict(data, **stale), "Back": stale})
+        with self.store.conn:
+            self.store.conn.execute("DELETE FROM meta WHERE key = 'schema'")
+        self.store.close()
+
+        self.store.open()
+        self.assertEqual([(f['name'], f['types']) for f in
+                          mtg.card_faces(self.store.get("Front"))],
+                         [('Front', ['creature']), ('Back', ['land'])])
+        self.assertEqual(mtg.card_faces(self.store.get("Back")),
+                         (self.store.get("Back"),))
+
+    def test_offline_cube(self):
+        """A cube resolves from the store without touching the API."""
+        self.store.import_bulk(self.bulk)
+        api = StubScryfall()
+        try:
+            path = os.path.join(self.tmp.name, 'cube.csv')
+            with open(path, 'w') as cube_file:
+                cube_file.write('"Pack Rat"\n"Pack Rat"\n"Far // Away"\n')
+            cube = cubealyzer.Cube(path, None, api_url=api.url,
+                                   store=self.store)
+            self.assertEqual(api.requests, [])
+            self.assertEqual(cube.cards.get("Pack Rat")['cmc'], 2.0)
+        finally:
+            api.close()
+
+    def test_shared(self):
+        """Cards downloaded for one cube are saved for the next."""
+        api = StubScryfall()
+        path = os.path.join(self.tmp.name, 'shared.db')
+        try:
+            cards = mtg.Cards(path, api_url=api.url)
+            cards.rate_limit = 0
+            cards.add_cards(["Pack Rat", "Gitaxian Probe"])
+            cards.save()
+            self.assertEqual(cards.new, set())
+
+            cards = mtg.Cards(path, api_url=api.url)
+            self.assertEqual(cards.db, {})
+            self.assertEqual(cards.add_cards(["Gitaxian Probe"]), [])
+            self.assertEqual(len(api.requests), 1)
+            self.assertEqual(cards.get("Pack Rat")['cmc'], 2.0)
+            self.assertEqual(len(cards.store), 2)
+        finally:
+            api.close()
+
+    def test_import_json(self):
+        """Card caches from older versions can be imported."""
+        path = os.path.join(self.tmp.name, 'cube.json')
+        legacy = {"Pack Rat": {'name': "Pack Rat", 'cost': '{1}{B}',
+                               'cmc': 2.0, 'types': ['creature'],
+                               'subtypes': ['rat']}}
+        with open(path, 'w') as json_file:
+            json.dump(legacy, json_file)
+        self.assertEqual(self.store.import_json(path), 1)
+        self.assertEqual(self.store.get("Pack Rat"),
+                         dict(legacy["Pack Rat"],
+                              mana=mtg.ManaCost.parse('{1}{B}')))
+
+    def test_compact(self):
+        """Compaction strips full Scryfall data down to the used fields."""
+        fat = dict(mtg.parse_card(STUB_CARDS[0]), oracle_text='x' * 10000,
+                   prices={'usd': '0.25'})
+        self.store.upsert({"Pack Rat": fat})
+        files = [self.store.path, self.store.path + '-wal']
+        size = sum(os.path.getsize(f) for f in files if os.path.exists(f))
+        self.store.compact(retain=('prices',))
+        self.assertLess(sum(os.path.getsize(f) for f in files if
+                            os.path.exists(f)), size)
+        self.assertEqual(set(self.store.get("Pack Rat")),
+                         set(mtg.card_fields) - {'faces'} | {'prices'})
+        self.assertEqual(os.listdir(self.tmp.name).count('cards.db.compact'),
+                         0)
+
+    def test_checkpoints(self):
+        """Card data downloaded before a failure is already in the store."""
+        api = StubScryfall()
+        try:
+            cards = mtg.Cards(store=self.store, api_url=api.url)
+            cards.workers = 1
+            fetch = cards.fetch_collection
+
+            def fetch_once(names, api_url):
+                if api.requests:
+                    exit("Killed")
+                return fetch(names, api_url)
+
+            cards.fetch_collection = fetch_once
+            with self.assertRaises(SystemExit):
+                cards.add_cards(["Filler {}".format(i) for i in range(80)])
+        finally:
+            api.close()
+        other = mtg.CardStore(self.store.path)
+        self.assertEqual(len(other), cards.batch_size)
+        self.assertEqual(other.conn.execute("PRAGMA journal_mode").fetchone(),
+                         ('wal',))
+        other.close()
+
+    def test_retain(self):
+        """Extra fields are only kept when asked for."""
+        data = dict(STUB_CARDS[0], oracle_text="Rat text")
+        self.assertNotIn('oracle_text', mtg.parse_card(data))
+        self.assertEqual(mtg.parse_card(data,
+                                        retain=('oracle_text',))['oracle_text'],
+                         "Rat text")
+
+
+class CacheTests(unittest.TestCase):
+    """Results of cubes cached on disk."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = cache.ResultCache(os.path.join(self.tmp.name, 'results'))
+        self.store = mtg.CardStore(os.path.join(self.tmp.name, 'cards.db'))
+        self.cube_file = os.path.join(self.tmp.name, 'cube.csv')
+        with open(self.cube_file, 'w') as cube_file:
+            cube_file.write('"Pack Rat"\n"Pack Rat"\n"Gitaxian Probe"\n')
+
+    def tearDown(self):
+        self.store.close()
+        self.tmp.cleanup()
+
+    def age(self, key, seconds):
+        """Make an entry look last used some seconds ago."""
+        then = time.time() - seconds
+        os.utime(self.cache.path(key), (then, then))
+
+    def test_version(self):
+        """The version of a store changes with its cards, and differs
+        between stores."""
+        version = self.store.version()
+        self.assertEqual(mtg.CardStore(self.store.path).version(), version)
+        self.store.upsert({"Pack Rat": mtg.parse_card(STUB_CARDS[0])})
+        self.assertNotEqual(self.store.version(), version)
+        self.assertNotEqual(mtg.CardStore(':memory:').version(),
+                            self.store.version())
+        self.assertIsNone(mtg.Cards().version())
+
+    def test_lru(self):
+        """Entries last used longest ago are evicted first."""
+        self.cache.put('a', 'x' * 1000)
+        self.cache.put('b', 'y' * 1000)
+        self.age('a', 20)
+        self.age('b', 10)
+        self.assertEqual(self.cache.get('a'), 'x' * 1000)
+        self.cache.max_bytes = 2500
+        self.cache.put('c', 'z' * 1000)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('a'), 'x' * 1000)
+        self.assertEqual(len(self.cache), 2)
+
+    def test_invalidate(self):
+        self.cache.put('a', 1)
+        self.cache.put('b', 2)
+        self.cache.invalidate('a')
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.get('b'), 2)
+        self.cache.invalidate()
+        self.assertEqual(len(self.cache), 0)
+        self.cache.invalidate('missing')
+
+    def test_unreadable(self):
+        """A damaged entry is dropped."""
+        self.cache.put('a', 1)
+        with open(self.cache.path('a'), 'wb') as entry:
+            entry.write(b'not a pickle')
+        with self.assertLogs(level='WARNING'):
+            self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_cube(self):
+        """A cube is counted again only if its file or card data change."""
+        api = StubScryfall()
+        try:
+            def load():
+                return cubealyzer.Cube(self.cube_file, None,
+                                       api_url=api.url, store=self.store,
+                                       cache=self.cache)
+
+            counted = load()
+            cached = load()
+            self.assertEqual(cached.cards.stats, Counter())
+            self.assertEqual(cached.contents, counted.contents)
+            self.assertEqual(cached.counts.table, counted.counts.table)
+            self.assertEqual(cached.index.names, counted.index.names)
+            self.assertEqual(cached.faction_curve('black'), {2.0: 2})
+            self.assertEqual(len(self.cache), 1)
+
+            with open(self.cube_file, 'a') as cube_file:
+                cube_file.write('"Isamaru, Hound of Konda"\n')
+            self.assertEqual(load().faction_curve('white'), {1.0: 1})
+            self.assertEqual(len(self.cache), 2)
+
+            self.store.upsert({"Pack Rat": mtg.parse_card(STUB_CARDS[0])})
+            self.assertNotEqual(load().cards.stats, Counter())
+            self.assertEqual(len(self.cache), 3)
+        finally:
+            api.close()
+
+
+class CurveTests(unittest.TestCase):
+    """Curves of a cube whose cards come from a local stand-in for
+    Scryfall."""
+
+    names = ["Pack Rat", "Pack Rat", "Isamaru, Hound of Konda",
+             "Gitaxian Probe", "Dryad Arbor", "Far // Away"] + \
+        ["Filler {}".format(i) for i in range(0, 80, 3)]
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.api = StubScryfall()
+        path = os.path.join(self.tmp.name, 'cube.csv')
+        with open(path, 'w') as cube_file:
+            cube_file.write(''.join('"{}"\n'.format(n) for n in self.names))
+        self.cube = cubealyzer.Cube(path, None, api_url=self.api.url)
+
+    def tearDown(self):
+        self.api.close()
+        self.tmp.cleanup()
+
+    def scan(self, faction, card_type, sub_type):
+        """The curve found by checking every card."""
+        conditions = [lambda c: sub_type is None or sub_type in c['subtypes']]
+        if faction is not None:
+            conditions.append(lambda c: mtg.Faction.can_play(
+                faction, mtg.card_mana(c)))
+        if card_type is None:
+            conditions.append(lambda c: {'creature', 'artifact'} &
+                              set(c['types']))
+        elif card_type != cubealyzer.Counts.any_type:
+            conditions.append(lambda c: card_type in c['types'])
+        return self.cube.conditional_curve(*conditions)
+
+    def test_counts(self):
+        """Counts from one pass agree with a scan for each curve."""
+        for faction in list(mtg.Faction.all_factions) + [None]:
+            for card_type in ('creature', 'sorcery', 'land', None,
+                              cubealyzer.Counts.any_type):
+                for sub_type in (None, 'rat', 'construct'):
+                    self.assertEqual(
+                        self.cube.faction_curve(faction, card_type, sub_type),
+                        self.scan(faction, card_type, sub_type))
+
+    def test_card_count(self):
+        """Duplicates count; Isamaru is not black, and Far // Away counts
+        once, as black can cast Away."""
+        self.assertEqual(self.cube.counts.total(None), len(self.names))
+        self.assertEqual(self.cube.card_count('black'),
+                         len(self.names) - 1)
+
+    def test_faces(self):
+        """Each half of a split card is counted in the curves, indexed and
+        queried as a card of its own, but the card only once in totals."""
+        self.assertEqual(self.cube.faction_curve('blue', 'instant'), {2.0: 1})
+        self.assertEqual(self.cube.faction_curve('black', 'instant'),
+                         {3.0: 1})
+        self.assertEqual(self.cube.faction_curve('dimir', 'instant'),
+                         {2.0: 1, 3.0: 1})
+        self.assertEqual(self.cube.counts.total('dimir', 'instant'), 1)
+        self.assertEqual(self.cube.counts.total('black', 'instant'), 1)
+        self.assertEqual(self.cube.find('blue', 'instant'), {"Far": 1})
+        self.assertEqual(self.cube.find('blue', 'instant', cmc=3.0), {})
+        self.assertEqual(self.cube.query('type:instant'),
+                         {"Far": 1, "Away": 1})
+        self.assertEqual(self.cube.query_curve('f:black type:instant'),
+                         {3.0: 1})
+        self.assertEqual(self.cube.cards_matching_conditions(
+            lambda c: c['cmc'] == 3.0, lambda c: 'instant' in c['types']),
+            {"Far // Away": 1})
+        if importlib.util.find_spec('numpy'):
+            summary = self.cube.simulation(
+                'g', 'instant', pack_size=len(self.names) // 3).simulate(
+                    10, seed=1)
+            self.assertEqual(summary['dimir'][2.0].mean, 1)
+            self.assertEqual(summary['dimir'][3.0].mean, 1)
+            self.assertEqual(summary['dimir'][None].mean, 1)
+        self.cube.update(self.cube.contents - Counter({"Far // Away": 1}))
+        self.assertEqual(self.cube.faction_curve(None, 'instant'), {})
+        self.assertNotIn("Away", self.cube.index.names)
+
+    def test_remove(self):
+        """Removing cards leaves no empty cmcs behind."""
+        self.cube.counts.add(self.cube.cards.get("Pack Rat"), -2)
+        self.assertNotIn(2.0, self.cube.faction_curve('black', 'creature',
+                                                      'rat'))
+
+    @unittest.skipUnless(importlib.util.find_spec('numpy'), "needs NumPy")
+    def test_columns(self):
+        """The columnar view agrees with the counts."""
+        cols = self.cube.columns()
+        for faction in list(mtg.Faction.all_factions) + [None]:
+            for card_type in ('creature', 'land', None, mtg.any_type):
+                for sub_type in (None, 'rat'):
+                    self.assertEqual(cols.curve(faction, card_type, sub_type),
+                                     self.cube.faction_curve(faction,
+                                                             card_type,
+                                                             sub_type))
+                    self.assertEqual(cols.total(faction, card_type, sub_type),
+                                     self.cube.counts.total(faction,
+                                                            card_type,
+                                                            sub_type))
+        for faction_type in mtg.Faction.fsh:
+            self.cube.update_curve(faction_type)
+            self.assertEqual(cols.curves(faction_type),
+                             self.cube.curve['creature'][None][faction_type])
+
+    @unittest.skipUnless(importlib.util.find_spec('numpy'), "needs NumPy")
+    def test_columns_where(self):
+        """Arbitrary conditions can be expressed on the columns."""
+        cols = self.cube.columns()
+        cheap = cols.cmc <= 1
+        self.assertEqual(cols.matching(cheap & cols.select('white')),
+                         self.cube.cards_matching_conditions(
+                             lambda c: c['cmc'] <= 1,
+                             lambda c: mtg.Faction.can_play(
+                                 'white', mtg.card_mana(c))))
+        cheap_creatures = cols.curve(None, 'creature', where=cheap)
+        self.assertEqual(sum(cheap_creatures.values()),
+                         sum(n for cmc, n in self.cube.faction_curve(
+                             None).items() if cmc <= 1))
+
+    @unittest.skipUnless(importlib.util.find_spec('numpy'), "needs NumPy")
+    def test_simulation(self):
+        """Drafts opening the whole cube see its curves; results depend only
+        on the seed."""
+        sim = self.cube.simulation('c', pack_size=len(self.names) // 3)
+        summary = sim.simulate(10, seed=1)
+        for faction in mtg.Faction.get_factions('c'):
+            curve = self.cube.faction_curve(faction)
+            for cmc, stats in summary[faction].items():
+                num = self.cube.counts.total(faction, 'creature') if cmc is \
+                    None else curve[cmc]
+                self.assertEqual(stats.mean, num)
+                self.assertEqual(stats.percentiles, (num, num, num))
+
+        sim = self.cube.simulation('g', packs=1)
+        sim.chunk_size = 250
+        self.assertEqual(sim.simulate(1000, seed=2),
+                         sim.simulate(1000, seed=2, processes=2))
+        black = sim.simulate(1000, seed=3)['orzhov'][None]
+        self.assertLess(black.percentiles[0], black.mean)
+        self.assertLess(black.mean, black.percentiles[-1])
+
+        with self.assertRaises(ValueError):
+            self.cube.simulation('c', packs=len(self.names))
+
+    def test_find(self):
+        """Cards found in the index are those a scan finds."""
+        for faction in ('simic', 'black', None):
+            for card_type in ('creature', 'land', None, mtg.any_type):
+                for sub_type in (None, 'rat', 'elf'):
+                    for cmc in (None, 2.0):
+                        curve = self.scan(faction, card_type, sub_type)
+                        found = self.cube.find(faction, card_type, sub_type,
+                                               cmc)
+                        self.assertEqual(sum(found.values()),
+                                         curve[cmc] if cmc is not None else
+                                         sum(curve.values()))
+        self.assertEqual(self.cube.find('black', 'creature', 'rat'),
+                         {"Pack Rat": 2})
+        self.cube.update(self.cube.contents - Counter({"Pack Rat": 2}))
+        self.assertEqual(self.cube.find('black', 'creature', 'rat'), {})
+        self.assertNotIn('rat', self.cube.index.subtypes)
+
+    def test_pips(self):
+        """Pips are counted with the curves, and follow updates."""
+        counts = self.cube.counts.pips
+        self.assertEqual(counts.curve('black'), {2.0: {'b': 2}})
+        self.assertEqual(counts.curve('orzhov'), {1.0: {'w': 1},
+                                                  2.0: {'b': 2}})
+        self.assertEqual(counts.requirements('orzhov'), {'w': {1.0: 1},
+                                                         'b': {2.0: 1}})
+        self.assertEqual(counts.sources('black'),
+                         {'b': pips.sources_needed(1, 2)})
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            self.cube.print_pips('c', 'creature', 'rat')
+        self.assertIn("type creature (any subtype, not only rat)",
+                      out.getvalue())
+        self.cube.update(self.cube.contents - Counter({"Pack Rat": 1}))
+        self.assertEqual(counts.curve('black'), {2.0: {'b': 1}})
+        self.cube.update(self.cube.contents - Counter({"Pack Rat": 1}))
+        self.assertEqual(counts.curve('black'), {})
+        self.assertEqual(counts.requirements('black'), {})
+
+    def test_query(self):
+        """Queries match the same cards as the equivalent conditions."""
+        playable = lambda f: lambda c: mtg.Faction.can_play(f, mtg.card_mana(c))
+        cases = {
+            'type:creature sub:rat cmc<=2 faction:golgari': [
+                lambda c: 'creature' in c['types'],
+                lambda c: 'rat' in c['subtypes'], lambda c: c['cmc'] <= 2,
+                playable('golgari')],
+            't:creature -sub:construct': [
+                lambda c: 'creature' in c['types'],
+                lambda c: 'construct' not in c['subtypes']],
+            'cmc>=3 cmc!=5 f:red': [lambda c: 3 <= c['cmc'] != 5,
+                                    playable('red')],
+            'name:"filler 1"': [lambda c: 'Filler 1' in c['name']],
+            'cmc:0 -type:land': [lambda c: c['cmc'] == 0,
+                                 lambda c: 'land' not in c['types']],
+        }
+        for expression, conditions in cases.items():
+            self.assertEqual(self.cube.query(expression),
+                             self.cube.cards_matching_conditions(*conditions))
+            self.assertEqual(self.cube.query_curve(expression),
+                             self.cube.conditional_curve(*conditions))
+        self.assertEqual(self.cube.query('sub:rat')["Pack Rat"], 2)
+        self.assertIs(query.compile('sub:rat'), query.compile('sub:rat'))
+
+    def test_timings(self):
+        """Phases are timed, and reported with the card data statistics."""
+        timings = cubealyzer.Timings()
+        with timings.phase('a'):
+            pass
+        with timings.phase('b'), timings.phase('a'):
+            time.sleep(.01)
+        self.assertEqual(list(timings.phases), ['a', 'b'])
+        self.assertGreaterEqual(timings.phases['b'], .01)
+        self.assertIn('card data', cubealyzer.timings.phases)
+
+        timings.cards = self.cube.cards
+        out = io.StringIO()
+        timings.report(out)
+        self.assertIn("downloaded      32", out.getvalue())
+        self.assertIn("playable masks", out.getvalue())
+
+    def test_update_curve(self):
+        """Curves of several faction types are kept side by side."""
+        self.cube.update_curve('c')
+        self.cube.update_curve('g')
+        self.assertEqual(set(self.cube.curve['creature'][None]), {'c', 'g'})
+
+    @unittest.skipUnless(importlib.util.find_spec('matplotlib'),
+                         "needs matplotlib")
+    def test_render_curve_plots(self):
+        """Plots are written to files for each faction type, through one
+        figure and without pyplot."""
+        paths = self.cube.render_curve_plots(['c', 's'], self.tmp.name,
+                                             sub_type='rat')
+        self.assertEqual([os.path.basename(p) for p in paths],
+                         ['cube-c-creature-rat.png', 'cube-s-creature-rat.png'])
+        for path in paths:
+            with open(path, 'rb') as image:
+                self.assertEqual(image.read(4), b'\x89PNG')
+        self.assertIs(cubealyzer.figure(), cubealyzer.figure())
+        self.assertEqual(len(cubealyzer.figure().axes), 1)
+        svg = self.cube.render_curve_plots(['g'], self.tmp.name,
+                                           card_type=None, plot_format='svg')
+        self.assertTrue(svg[0].endswith('cube-g-permanent.svg'))
+        self.assertNotIn('matplotlib.pyplot', sys.modules)
+
+    def test_reload(self):
+        """Edits to the cube file are applied as changes to the counts and
+        curves, fetching only the cards added."""
+        self.cube.update_curve('c')
+        names = self.names[1:] + ["Filler 1", "Filler 1", "Not a card"]
+        with open(self.cube.csv_file, 'w') as cube_file:
+            cube_file.write(''.join('"{}"\n'.format(n) for n in names))
+        requests = len(self.api.requests)
+
+        with self.assertLogs(level='WARNING'):
+            delta = self.cube.reload()
+
+        self.assertEqual(delta, {"Pack Rat": -1, "Filler 1": 2})
+        self.assertEqual(len(self.api.requests), requests + 1)
+        self.assertNotIn("Not a card", self.cube.contents)
+        fresh = cubealyzer.Counts(self.cube)
+        self.assertEqual({k: +v for k, v in self.cube.counts.table.items()
+                          if +v}, {k: v for k, v in fresh.table.items()})
+        self.assertEqual(self.cube.curve['creature'][None]['c']['black'],
+                         fresh.curve('black'))
+        index = cubealyzer.Index(self.cube)
+        for attr in ('names', 'types', 'subtypes', 'cmcs', 'factions'):
+            self.assertEqual(getattr(self.cube.index, attr),
+                             getattr(index, attr))
+
+        self.assertEqual(self.cube.reload(), {})
+
+
+class BatchTests(unittest.TestCase):
+    """Several cubes analyzed and compared in one run."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.api = StubScryfall()
+        self.db = os.path.join(self.tmp.name, 'cards.db')
+        self.dir = os.path.join(self.tmp.name, 'cubes')
+        os.mkdir(self.dir)
+        cubes = {'a.csv': ["Pack Rat", "Isamaru, Hound of Konda"],
+                 'b.csv': ["Pack Rat", "Pack Rat", "Filler 3"],
+                 'c.csv': ["Gitaxian Probe", "Far // Away"]}
+        for name, cards in cubes.items():
+            with open(os.path.join(self.dir, name), 'w') as cube_file:
+                cube_file.write(''.join('"{}"\n'.format(c) for c in cards))
+
+    def tearDown(self):
+        self.api.close()
+        self.tmp.cleanup()
+
+    def test_batch(self):
+        """Card data is resolved once, and each cube is compared with the
+        one before."""
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            cubealyzer.batch(cubealyzer.cube_files([self.dir]), self.db,
+                             ['c'], processes=2, api_url=self.api.url)
+        report = out.getvalue()
+        self.assertEqual(self.api.requests, [('POST', '/cards/collection')])
+        for name in ('a.csv', 'b.csv', 'c.csv'):
+            self.assertIn(os.path.join(self.dir, name), report)
+        self.assertEqual(report.count(' -> '), 2)
+        # a -> b: one more black rat and one fewer white one-drop
+        self.assertIn("black       +2", report)
+        self.assertIn("white       1:-1 ", report)
+
+    def test_export(self):
+        """The curves of every cube are exported as rows, each followed by
+        its number of cards; those for any card are the card counts."""
+        path = os.path.join(self.tmp.name, 'curves.jsonl')
+        with contextlib.redirect_stdout(io.StringIO()):
+            cubealyzer.batch(cubealyzer.cube_files([self.dir]), self.db,
+                             ['c', 'g'], processes=2, api_url=self.api.url,
+                             export_file=path)
+        with open(path) as rows_file:
+            rows = [json.loads(line) for line in rows_file]
+        self.assertEqual(set(rows[0]), set(export.fields))
+        b = os.path.join(self.dir, 'b.csv')
+        self.assertEqual(sum(r['count'] for r in rows if r['cube'] == b and
+                             r['faction'] == 'black' and
+                             r['type'] == mtg.any_type and
+                             r['cmc'] is not None), 3)
+        self.assertIn({'cube': b, 'faction_type': 'c', 'faction': 'black',
+                       'type': mtg.any_type, 'subtype': None, 'cmc': None,
+                       'count': 3}, rows)
+        # Both faces of Far // Away are in dimir's curve, the card once in
+        # its total
+        c = os.path.join(self.dir, 'c.csv')
+        dimir = [r for r in rows if r['cube'] == c and r['faction'] ==
+                 'dimir' and r['type'] == mtg.any_type]
+        self.assertEqual(sum(r['count'] for r in dimir if r['cmc'] is not
+                             None), 3)
+        self.assertEqual([r['count'] for r in dimir if r['cmc'] is None],
+                         [2])
+        self.assertIn({'cube': b, 'faction_type': 'c', 'faction': 'black',
+                       'type': 'creature', 'subtype': None, 'cmc': 2.0,
+                       'count': 2}, rows)
+
+    def test_options(self):
+        """Options that only apply to one cube are refused, not ignored."""
+        result = subprocess.run(
+            [sys.executable, cubealyzer.__file__, '--db', self.db,
+             '--no-cache', '-c', '-q', 'type:instant', '--pips', self.dir],
+            capture_output=True, text=True)
+        self.assertEqual(result.returncode, 2)
+        self.assertIn("-q, --pips can only be used with one cube",
+                      result.stderr)
+        self.assertEqual(self.api.requests, [])
+
+    def test_cube_files(self):
+        """Directories expand to the CSV files in them, in order."""
+        files = cubealyzer.cube_files([self.dir, 'other.csv'])
+        self.assertEqual([os.path.basename(f) for f in files],
+                         ['a.csv', 'b.csv', 'c.csv', 'other.csv'])
+
+
+class ExportTests(unittest.TestCase):
+    """Rows written in each format."""
+
+    curves = {'creature': {None: {'c': {'white': {1.0: 2, 3.0: 1},
+                                        'blue': {}}}}}
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_csv(self):
+        path = os.path.join(self.tmp.name, 'curves.csv')
+        with export.RowWriter(path) as writer:
+            writer.write(export.rows('cube.csv', self.curves))
+        with open(path, newline='') as rows_file:
+            rows = list(csv.DictReader(rows_file))
+        self.assertEqual([(r['faction'], r['cmc'], r['count']) for r in rows],
+                         [('white', '1.0', '2'), ('white', '3.0', '1')])
+        self.assertEqual(rows[0]['subtype'], '')
+
+    def test_format(self):
+        with self.assertRaises(ValueError):
+            export.RowWriter(os.path.join(self.tmp.name, 'curves.xlsx'))
+
+    def export_stdout(self, *options):
+        """Lines written by cubealyzer exporting a cube to standard output,
+        with its card data in a store."""
+        store = mtg.CardStore(os.path.join(self.tmp.name, 'cards.db'))
+        store.upsert({card['name']: mtg.parse_card(card) for card in
+                      STUB_CARDS})
+        store.close()
+        path = os.path.join(self.tmp.name, 'cube.csv')
+        with open(path, 'w') as cube_file:
+            cube_file.write('"Pack Rat"\n"Far // Away"\n')
+            cube_file.write(''.join('"Filler {}"\n'.format(i) for i in
+                                    range(20)))
+        result = subprocess.run(
+            [sys.executable, cubealyzer.__file__, '--db', store.path,
+             '--no-cache', '-c', '--export', '-', *options, path],
+            capture_output=True, text=True, check=True)
+        return result.stdout.splitlines()
+
+    def test_stdout(self):
+        """Exported to standard output, the rows are the only output."""
+        lines = self.export_stdout('-q', 'type:instant', '--pips',
+                                   '--simulate', '10', '--packs', '1',
+                                   '-j', '1')
+        self.assertTrue(lines)
+        for line in lines:
+            self.assertIn('faction', json.loads(line))
+
+    def test_watch_stdout(self):
+        """Watching a cube exported to standard output, the rows are still
+        the only output after it changes."""
+        store = mtg.CardStore(os.path.join(self.tmp.name, 'cards.db'))
+        store.upsert({card['name']: mtg.parse_card(card) for card in
+                      STUB_CARDS})
+        store.close()
+        path = os.path.join(self.tmp.name, 'cube.csv')
+        with open(path, 'w') as cube_file:
+            cube_file.write('"Pack Rat"\n')
+        process = subprocess.Popen(
+            [sys.executable, cubealyzer.__file__, '--db', store.path,
+             '--no-cache', '-c', '--export', '-', '--watch', path],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        try:
+            # Pack Rat's creature and any card rows, each with its total
+            lines = [process.stdout.readline() for i in range(4)]
+            time.sleep(1)
+            with open(path, 'a') as cube_file:
+                cube_file.write('"Gitaxian Probe"\n')
+            time.sleep(2)
+        finally:
+            process.terminate()
+            stdout, stderr = process.communicate(timeout=10)
+        lines += stdout.splitlines()
+        self.assertGreater(len(lines), 8)
+        for line in lines:
+            self.assertIn('faction', json.loads(line))
+        self.assertIn("+1 Gitaxian Probe", stderr)
+
+    @unittest.skipUnless(importlib.util.find_spec('pyarrow'),
+                         "needs pyarrow")
+    def test_parquet(self):
+        import pyarrow.parquet
+        path = os.path.join(self.tmp.name, 'curves.parquet')
+        with export.RowWriter(path) as writer:
+            writer.batch_size = 1
+            writer.write(export.rows('cube.csv', self.curves))
+        table = pyarrow.parquet.read_table(path)
+        self.assertEqual(table.column('count').to_pylist(), [2, 1])
+
+
+class QueryTests(unittest.TestCase):
+    """Parsing filter expressions."""
+
+    def test_parse(self):
+        self.assertEqual(query.parse('Type:Creature -sub:elf cmc<=3'), (
+            query.Term('type', ':', 'creature', False),
+            query.Term('subtype', ':', 'elf', True),
+            query.Term('cmc', '<=', 3.0, False)))
+        self.assertEqual(query.parse('name:"pack rat"')[0].value, 'pack rat')
+        self.assertEqual(query.parse(''), ())
+
+    def test_errors(self):
+        for expression in ('creature', 'color:red', 'cmc<three', 'type<3',
+                           'faction:purple'):
+            with self.assertRaises(ValueError):
+                query.parse(expression)
+
+
+class PipsTests(unittest.TestCase):
+    """Colored pips of mana costs and the sources needed for them."""
+
+    def test_weights(self):
+        cost = mtg.ManaCost.parse('{1}{W}{W}{U/B}{2/R}{G/P}{HW}')
+        self.assertEqual(pips.pips(cost), ((2.5, .5, .5, .5, .5),
+                                           (2, 0, 0, 0, 0)))
+        # Only the colors of the deck pay hybrid and phyrexian pips
+        self.assertEqual(pips.pips(cost, mtg.Faction.cm['orzhov']),
+                         ((2.5, 0, 1, 0, 0), (2, 0, 1, 0, 0)))
+        self.assertEqual(pips.pips(mtg.ManaCost.parse('{3}{C}')),
+                         ((0,) * 5, (0,) * 5))
+
+    def test_sources(self):
+        self.assertEqual(pips.sources_needed(0, 1), 0)
+        self.assertLess(pips.sources_needed(1, 4), pips.sources_needed(1, 1))
+        self.assertLess(pips.sources_needed(1, 2), pips.sources_needed(2, 2))
+        self.assertEqual(pips.sources_needed(1, 1, probability=1), None)
+        self.assertEqual(pips.sources_needed(1, 1, lands=40, probability=1),
+                         34)
+
+
+class ServerTests(unittest.TestCase):
+    """Cubes posted to a local analysis server."""
+
+    cube = '"Pack Rat"\n"Pack Rat"\n"Isamaru, Hound of Konda"\n'
+
+    def setUp(self):
+        self.api = StubScryfall()
+        self.httpd = server.make_server(mtg.Cards(api_url=self.api.url),
+                                        port=0)
+        self.url = 'http://127.0.0.1:{}'.format(self.httpd.server_port)
+        threading.Thread(target=self.httpd.serve_forever, args=(.05,),
+                         daemon=True).start()
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.api.close()
+
+    def post(self, body, query='factions=cg'):
+        request = urllib.request.Request(self.url + '/analyze?' + query,
+                                         data=body.encode())
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status, json.load(response)
+        except urllib.error.HTTPError as e:
+            return e.code, json.load(e)
+
+    def test_api_failure(self):
+        """A failure of the API is answered with 502, and the server goes
+        on serving."""
+        self.httpd.analyzer.cards.max_retries = 0
+        self.api.failures.append((503, ()))
+        status, result = self.post(self.cube)
+        self.assertEqual(status, 502)
+        self.assertIn('503', result['error'])
+        self.assertEqual(self.post(self.cube)[0], 200)
+
+    def test_analyze(self):
+        """Counts are returned, and repeated requests are answered from
+        memory."""
+        status, result = self.post(self.cube)
+        self.assertEqual(status, 200)
+        self.assertEqual(result['summary']['c']['cards']['black'], 2)
+        self.assertEqual(result['summary']['g']['curves']['orzhov'],
+                         {'1.0': 1, '2.0': 2})
+        requests = len(self.api.requests)
+        self.assertEqual(self.post(self.cube), (status, result))
+        self.assertEqual(len(self.api.requests), requests)
+        # Another analysis of the same cube needs no new card data either
+        status, rats = self.post(self.cube, 'factions=c&subtype=rat')
+        self.assertEqual(rats['summary']['c']['types']['white'], 0)
+        self.assertEqual(len(self.api.requests), requests)
+
+    def test_query(self):
+        status, result = self.post(self.cube, 'query=sub:rat')
+        self.assertEqual(result['query'], {'cards': {"Pack Rat": 2},
+                                           'curve': {'2.0': 2}})
+        self.assertEqual(self.post(self.cube, 'query=cmc<x')[0], 400)
+
+    def test_missing(self):
+        status, result = self.post(self.cube + '"Not a card"\n')
+        self.assertEqual(status, 422)
+        self.assertEqual(result, {'missing': ["Not a card"]})
+        self.assertEqual(self.post('', 'factions=x')[0], 400)
+
+    def test_results_cache(self):
+        """Only the most recent results are kept."""
+        self.httpd.analyzer.max_results = 1
+        self.post(self.cube)
+        first = self.post('"Gitaxian Probe"\n')[1]['cube']
+        self.assertEqual(list(self.httpd.analyzer.results), [first])
+        with urllib.request.urlopen(self.url + '/status') as response:
+            self.assertEqual(json.load(response), {'cards': 3, 'results': 1})
+
+
+class StartupTests(unittest.TestCase):
+    """Modules needed only for plots, downloads or colors load on demand."""
+
+    def test_lazy_imports(self):
+        """Importing cubealyzer does not import them."""
+        code = ('import sys, cubealyzer; print(" ".join(sorted('
+                'set(sys.modules) & {"matplotlib", "requests", "colorama", '
+                '"numpy"})))')
+        result = subprocess.run([sys.executable, '-c', code],
+                                capture_output=True, text=True, check=True)
+        self.assertEqual(result.stdout.strip(), '')
+
+
+class TokenBucketTests(unittest.TestCase):
+    """Rate limiting shared between fetch workers."""
+
+    def test_rate(self):
+        """Tokens are handed out no faster than the configured rate."""
+        bucket = mtg.TokenBucket(50)
+        start = time.monotonic()
+        threads = [threading.Thread(target=bucket.take) for _ in range(11)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertGreaterEqual(time.monotonic() - start, .19)
+
+    def test_hold(self):
+        """A hold delays the next token."""
+        bucket = mtg.TokenBucket(1000)
+        bucket.hold(.2)
+        self.assertGreaterEqual(bucket.take(), .19)
+
+    def test_unlimited(self):
+        """A rate of zero never waits."""
+        bucket = mtg.TokenBucket(0)
+        self.assertEqual(sum(bucket.take() for _ in range(100)), 0)
+
+
 if __name__ == "__main__":
     unittest.main()